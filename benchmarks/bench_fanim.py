@@ -0,0 +1,264 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of the FAnim timeline, run against the fake gimpfu module.
+
+Every benchmark runs on images of each requested frame count, with the
+simulated PDB latency applied to the measured part only. Results are
+written as JSON lines, one per benchmark and frame count.
+
+It needs PyGObject with GTK 3 and a display, xvfb-run works for headless
+machines. numpy is optional, as for the plug-in.
+
+    xvfb-run python3 benchmarks/bench_fanim.py --frames 10,100 --latency 50
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(1, os.path.dirname(HERE))
+
+import fake_gimpfu
+sys.modules["gimpfu"] = fake_gimpfu
+
+import fanim
+from gi.repository import Gtk
+
+
+def pump():
+    while Gtk.events_pending():
+        Gtk.main_iteration()
+
+
+def new_timeline(args, frames):
+    image = fake_gimpfu.make_image(frames, args.width, args.height, args.fixed_every)
+    fake_gimpfu.set_latency(0)
+    timeline = fanim.Timeline("FAnim benchmark", image)
+    while timeline.load_job is not None:
+        Gtk.main_iteration()
+    pump()
+    return timeline
+
+
+def bench_startup(timeline, args):
+    """Open another timeline on the image and wait until every frame is read."""
+    other = fanim.Timeline("FAnim startup", timeline.image)
+    while other.load_job is not None:
+        Gtk.main_iteration()
+    other.hide()
+
+
+def bench_scan_cold(timeline, args):
+    """Rescan with every frame unknown, like opening the timeline."""
+    timeline.frames = []
+    timeline._scan_image_layers()
+
+
+def bench_scan_warm(timeline, args):
+    """Rescan of an unchanged image, like on every focus."""
+    timeline._scan_image_layers()
+
+
+def bench_focus(timeline, args):
+    """Focus check of an unchanged image, once the events settled."""
+    for _ in range(args.steps):
+        timeline._check_image()
+
+
+def bench_goto(timeline, args):
+    for _ in range(min(args.steps, len(timeline.frames))):
+        timeline.on_goto(None, fanim.NEXT)
+
+
+def bench_scrub(timeline, args):
+    """Scrub requests faster than the redraws, merged into one frame change."""
+    for _ in range(args.steps):
+        timeline.request_step(1)
+    pump()
+
+
+def bench_player(timeline, args):
+    """Play once from the first frame to the last one, as fast as it goes."""
+    timeline.framerate = 100000
+    timeline.drop_frames = False
+    timeline.is_replay = False
+    timeline.on_goto(None, fanim.START)
+
+    timeline.on_toggle_play(Gtk.Button())
+    while timeline.is_playing:
+        Gtk.main_iteration()
+
+
+def bench_proxies(timeline, args):
+    """Render the playback proxies for two preview sizes, then the first again."""
+    cache = timeline.playback_cache
+    for width, height in ((320, 180), (640, 360), (320, 180)):
+        for _ in cache.prepare(width, height):
+            pass
+
+
+def bench_move_range(timeline, args):
+    """Move a range of frames from the start to the end of the timeline."""
+    count = len(timeline.frames)
+    last = min(args.steps, count) - 1
+    timeline.active = 0
+    timeline.move_range(0, last, count - 1 - last)
+
+
+def bench_onionskin(timeline, args):
+    timeline.oskin_depth = fanim.OSKIN_MAX_DEPTH
+    timeline.oskin_forward = True
+    timeline.oskin_backward = True
+    for _ in range(args.steps):
+        timeline.on_onionskin(None)
+
+
+def bench_onionskin_overlay(timeline, args):
+    """Step through the frames with the tinted onion skin overlay shown."""
+    timeline.oskin_depth = fanim.OSKIN_MAX_DEPTH
+    timeline.oskin_forward = True
+    timeline.oskin_backward = True
+    timeline.oskin_overlay = True
+    timeline.oskin = True
+    for _ in range(min(args.steps, len(timeline.frames))):
+        timeline.on_goto(None, fanim.NEXT)
+    timeline.oskin = False
+    timeline.oskin_overlay = False
+    timeline.on_goto(None, fanim.NOWHERE)
+
+
+def run_export(timeline, format):
+    """Start an export and run the main loop until its job is done."""
+    timeline.create_formated_version(None, format)
+    while timeline.export_job is not None:
+        Gtk.main_iteration()
+
+
+def bench_export_gif(timeline, args):
+    run_export(timeline, 'gif')
+
+
+def bench_export_spritesheet(timeline, args):
+    """Spritesheet with its index table, without the file chooser."""
+    path = os.path.join(fake_gimpfu.gimp.directory, "sheet.json")
+    timeline._choose_sheet_index_path = lambda: path
+    run_export(timeline, 'spritesheet')
+
+
+def bench_export_atlas(timeline, args):
+    """Trimmed and packed atlas, run straight without the file chooser."""
+    if fanim.np is None:
+        return
+    path = os.path.join(fake_gimpfu.gimp.directory, "atlas.json")
+    for _ in timeline._create_atlas(path):
+        pass
+
+
+def bench_export_apng(timeline, args):
+    """Animated PNG streamed frame by frame, without the file chooser."""
+    if fanim.np is None:
+        return
+    path = os.path.join(fake_gimpfu.gimp.directory, "animation.png")
+    for _ in timeline._write_animation(path, fanim.ApngWriter):
+        pass
+
+
+BENCHMARKS = [
+    ("startup", bench_startup),
+    ("scan_cold", bench_scan_cold),
+    ("scan_warm", bench_scan_warm),
+    ("focus", bench_focus),
+    ("goto", bench_goto),
+    ("scrub", bench_scrub),
+    ("player", bench_player),
+    ("proxies", bench_proxies),
+    ("move_range", bench_move_range),
+    ("onionskin", bench_onionskin),
+    ("onionskin_overlay", bench_onionskin_overlay),
+    ("export_gif", bench_export_gif),
+    ("export_spritesheet", bench_export_spritesheet),
+    ("export_atlas", bench_export_atlas),
+    ("export_apng", bench_export_apng),
+]
+
+
+def run(args, out):
+    selected = args.only.split(",") if args.only else None
+    environment = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": fanim.np is not None,
+        "latency_us": args.latency,
+        "width": args.width,
+        "height": args.height,
+        "fixed_every": args.fixed_every,
+    }
+
+    for frames in [int(n) for n in args.frames.split(",")]:
+        timeline = new_timeline(args, frames)
+
+        for name, bench in BENCHMARKS:
+            if selected and name not in selected:
+                continue
+
+            times = []
+            for _ in range(args.repeat):
+                fake_gimpfu.reset_stats()
+                fake_gimpfu.set_latency(args.latency / 1e6)
+                start = time.perf_counter()
+                bench(timeline, args)
+                times.append(time.perf_counter() - start)
+                fake_gimpfu.set_latency(0)
+                pump()
+
+            record = {"benchmark": name, "frames": frames,
+                      "seconds_min": min(times),
+                      "seconds_median": statistics.median(times),
+                      "repeat": args.repeat,
+                      "pdb_calls": fake_gimpfu.STATS["calls"],
+                      "flushes": timeline.flush_count}
+            record.update(environment)
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+
+        timeline.hide()
+        pump()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--frames", default="10,100,1000,5000",
+                        help="comma separated frame counts (default: %(default)s)")
+    parser.add_argument("--width", type=int, default=64)
+    parser.add_argument("--height", type=int, default=64)
+    parser.add_argument("--fixed-every", type=int, default=25,
+                        help="make the first and every n-th frame fixed, 0 for none")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="simulated PDB latency per call in microseconds")
+    parser.add_argument("--steps", type=int, default=200,
+                        help="navigation steps and onion skin toggles per run")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", default="",
+                        help="comma separated benchmarks to run: " +
+                        ", ".join(name for name, bench in BENCHMARKS))
+    parser.add_argument("--output", default="-",
+                        help="JSON lines output file, - for stdout")
+    args = parser.parse_args()
+
+    if args.output == "-":
+        run(args, sys.stdout)
+    else:
+        with open(args.output, "a") as out:
+            run(args, out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+
+"""
+Stand-in for the gimpfu module, so fanim.py can be driven outside of GIMP.
+
+Images and layers live in memory. The cost of the wire between a plug-in
+and GIMP is simulated: every PDB procedure, and every property access that
+is a PDB call in the real module, waits LATENCY seconds and is counted in
+STATS["calls"].
+"""
+
+import os
+import tempfile
+import time
+
+TRANSPARENT_FILL = 3
+RGB, GRAY, INDEXED = 0, 1, 2
+RGB_IMAGE, RGBA_IMAGE = 0, 1
+NORMAL_MODE = 0
+EXPAND_AS_NECESSARY, CLIP_TO_IMAGE = 0, 1
+PARASITE_PERSISTENT = 1
+
+LATENCY = 0.0
+STATS = {"calls": 0}
+
+_next_id = [0]
+_images = []
+
+
+def set_latency(seconds):
+    global LATENCY
+    LATENCY = seconds
+
+
+def reset_stats():
+    STATS["calls"] = 0
+
+
+def _call():
+    STATS["calls"] += 1
+    if LATENCY:
+        # busy wait, sleep() is far too coarse for microseconds.
+        end = time.perf_counter() + LATENCY
+        while time.perf_counter() < end:
+            pass
+
+
+def _new_id():
+    _next_id[0] += 1
+    return _next_id[0]
+
+
+def _color(seed):
+    return bytes(((seed * 67) % 256, (seed * 131) % 256, (seed * 29) % 256))
+
+
+def _pdb_property(attribute):
+    """Property going through the PDB, like drawable properties in gimpfu."""
+    def get(self):
+        _call()
+        return getattr(self, attribute)
+
+    def set(self, value):
+        _call()
+        setattr(self, attribute, value)
+    return property(get, set)
+
+
+class Parasite:
+
+    def __init__(self, name, flags, data):
+        self.name = name
+        self.flags = flags
+        self.data = data
+
+
+class PixelRegion:
+
+    def __init__(self, drawable, x, y, width, height):
+        self.drawable = drawable
+        self.x, self.y = x, y
+        self.w, self.h = width, height
+        self.bpp = drawable.bpp
+
+    def __getitem__(self, key):
+        _call()
+        xs, ys = key
+        return self.drawable._read(xs.start, ys.start, xs.stop, ys.stop)
+
+    def __setitem__(self, key, data):
+        _call()
+        xs, ys = key
+        self.drawable._write(xs.start, ys.start, xs.stop, ys.stop, data)
+
+
+class Layer:
+
+    def __init__(self, image, name, width, height, type=RGBA_IMAGE,
+                 opacity=100.0, mode=NORMAL_MODE):
+        self.ID = _new_id()
+        self.image = image
+        self.bpp = 4 if type == RGBA_IMAGE else 3
+        self.is_indexed = False
+        self.parent = None
+
+        self._name = name
+        self._width = width
+        self._height = height
+        self._opacity = opacity
+        self._mode = mode
+        self._visible = True
+        self._offsets = (0, 0)
+        self._pixels = None
+        self._parasites = {}
+
+    def __eq__(self, other):
+        return isinstance(other, Layer) and other.ID == self.ID
+
+    def __hash__(self):
+        return self.ID
+
+    name = _pdb_property("_name")
+    visible = _pdb_property("_visible")
+    opacity = _pdb_property("_opacity")
+    mode = _pdb_property("_mode")
+    offsets = _pdb_property("_offsets")
+
+    @property
+    def width(self):
+        _call()
+        return self._width
+
+    @property
+    def height(self):
+        _call()
+        return self._height
+
+    @property
+    def tattoo(self):
+        _call()
+        return self.ID
+
+    def _data(self):
+        if self._pixels is None:
+            pixel = _color(self.ID) + (b"\xff" if self.bpp == 4 else b"")
+            self._pixels = bytearray(pixel * (self._width * self._height))
+        return self._pixels
+
+    def _read(self, x0, y0, x1, y1):
+        data = self._data()
+        if (x0, y0, x1, y1) == (0, 0, self._width, self._height):
+            return bytes(data)
+        row = self._width * self.bpp
+        return b"".join(bytes(data[y * row + x0 * self.bpp:y * row + x1 * self.bpp])
+                        for y in range(y0, y1))
+
+    def _write(self, x0, y0, x1, y1, chunk):
+        data = self._data()
+        if (x0, y0, x1, y1) == (0, 0, self._width, self._height):
+            data[:] = chunk
+            return
+        row = self._width * self.bpp
+        span = (x1 - x0) * self.bpp
+        for i, y in enumerate(range(y0, y1)):
+            data[y * row + x0 * self.bpp:y * row + x1 * self.bpp] = \
+                chunk[i * span:(i + 1) * span]
+
+    def _clone(self, image):
+        layer = Layer(image, self._name, self._width, self._height,
+                      RGBA_IMAGE if self.bpp == 4 else RGB_IMAGE,
+                      self._opacity, self._mode)
+        layer._visible = self._visible
+        layer._offsets = self._offsets
+        layer._parasites = dict(self._parasites)
+        if self._pixels is not None:
+            layer._pixels = bytearray(self._pixels)
+        return layer
+
+    def copy(self):
+        _call()
+        return self._clone(self.image)
+
+    def parasite_find(self, name):
+        _call()
+        return self._parasites.get(name)
+
+    def attach_new_parasite(self, name, flags, data):
+        _call()
+        self._parasites[name] = Parasite(name, flags, data)
+
+    def parasite_detach(self, name):
+        _call()
+        self._parasites.pop(name, None)
+
+    def get_pixel_rgn(self, x, y, width, height, dirty=True, shadow=False):
+        _call()
+        return PixelRegion(self, x, y, width, height)
+
+    def flush(self):
+        _call()
+
+    def merge_shadow(self, undo=True):
+        _call()
+
+    def update(self, x, y, width, height):
+        _call()
+
+    def transform_2d(self, source_x, source_y, scale_x, scale_y, angle,
+                     dest_x, dest_y, direction, interpolation):
+        _call()
+        self._offsets = (int(dest_x), int(dest_y))
+        return self
+
+
+class GroupLayer(Layer):
+
+    def __init__(self, image, name="Group", opacity=100.0, mode=NORMAL_MODE):
+        super().__init__(image, name, image._width, image._height,
+                         RGBA_IMAGE, opacity, mode)
+        self._layers = []
+
+    @property
+    def layers(self):
+        _call()
+        return list(self._layers)
+
+
+class Image:
+
+    def __init__(self, width, height, type=RGB):
+        self.ID = _new_id()
+        self.base_type = type
+        self.filename = None
+        self.name = "Untitled-%d" % self.ID
+
+        self._width = width
+        self._height = height
+        self._layers = []
+        self._active = None
+        self._dirty = 0
+        self._parasites = {}
+        _images.append(self)
+
+    def __eq__(self, other):
+        return isinstance(other, Image) and other.ID == self.ID
+
+    def __hash__(self):
+        return self.ID
+
+    @property
+    def width(self):
+        _call()
+        return self._width
+
+    @property
+    def height(self):
+        _call()
+        return self._height
+
+    @property
+    def layers(self):
+        _call()
+        return list(self._layers)
+
+    @property
+    def active_layer(self):
+        _call()
+        return self._active
+
+    @active_layer.setter
+    def active_layer(self, layer):
+        _call()
+        self._active = layer
+
+    def _siblings(self, layer):
+        if layer.parent is None:
+            return self._layers
+        return layer.parent._layers
+
+    def add_layer(self, layer, position=-1):
+        self.insert_layer(layer, None, position)
+
+    def insert_layer(self, layer, parent=None, position=-1):
+        _call()
+        siblings = self._layers if parent is None else parent._layers
+        if position < 0:
+            position = 0
+        siblings.insert(min(position, len(siblings)), layer)
+        layer.parent = parent
+        layer.image = self
+        self._dirty += 1
+
+    def remove_layer(self, layer):
+        _call()
+        self._siblings(layer).remove(layer)
+        if self._active == layer:
+            self._active = None
+        self._dirty += 1
+
+    def _reorder(self, layer, position):
+        siblings = self._siblings(layer)
+        siblings.remove(layer)
+        siblings.insert(max(0, min(position, len(siblings))), layer)
+        self._dirty += 1
+
+    def raise_layer(self, layer):
+        _call()
+        self._reorder(layer, self._siblings(layer).index(layer) - 1)
+
+    def lower_layer(self, layer):
+        _call()
+        self._reorder(layer, self._siblings(layer).index(layer) + 1)
+
+    def merge_down(self, layer, merge_type):
+        _call()
+        siblings = self._siblings(layer)
+        below = siblings[siblings.index(layer) + 1]
+        siblings.remove(layer)
+        self._dirty += 1
+        return below
+
+    def merge_visible_layers(self, merge_type):
+        _call()
+        visible = [l for l in self._layers if l._visible]
+        if not visible:
+            return None
+        for layer in visible[:-1]:
+            self._layers.remove(layer)
+        self._dirty += 1
+        return visible[-1]
+
+    def parasite_find(self, name):
+        _call()
+        return self._parasites.get(name)
+
+    def attach_new_parasite(self, name, flags, data):
+        _call()
+        self._parasites[name] = Parasite(name, flags, data)
+        self._dirty += 1
+
+    def undo_freeze(self):
+        _call()
+
+    def undo_thaw(self):
+        _call()
+
+    def undo_group_start(self):
+        _call()
+
+    def undo_group_end(self):
+        _call()
+
+    def disable_undo(self):
+        _call()
+
+    def enable_undo(self):
+        _call()
+
+
+class Display:
+
+    def __init__(self, image):
+        _call()
+        self.image = image
+
+
+class _PDB:
+    """Procedures fanim.py calls, anything else is a counted no-op."""
+
+    def gimp_drawable_thumbnail(self, drawable, width, height):
+        _call()
+        scale = min(float(width) / drawable._width, float(height) / drawable._height, 1.0)
+        w = max(1, int(drawable._width * scale))
+        h = max(1, int(drawable._height * scale))
+        # nearest pixels of the layer, so edits show in the thumbnail.
+        pixels, bpp = drawable._data(), drawable.bpp
+        if (w, h) == (drawable._width, drawable._height):
+            data = bytes(pixels)
+        else:
+            stride = drawable._width * bpp
+            columns = [x * drawable._width // w * bpp for x in range(w)]
+            data = b"".join(pixels[row + c:row + c + bpp]
+                            for row in (y * drawable._height // h * stride for y in range(h))
+                            for c in columns)
+        return (w, h, bpp, len(data), data)
+
+    def gimp_layer_new_from_drawable(self, drawable, image):
+        _call()
+        return drawable._clone(image)
+
+    def gimp_image_get_colormap(self, image):
+        _call()
+        return (0, b"")
+
+    def gimp_image_delete(self, image):
+        _call()
+        if image in _images:
+            _images.remove(image)
+
+    def gimp_image_is_dirty(self, image):
+        _call()
+        return image._dirty > 0
+
+    def gimp_image_reorder_item(self, image, item, parent, position):
+        _call()
+        image._reorder(item, position)
+
+    def __getattr__(self, name):
+        def procedure(*args, **kwargs):
+            _call()
+        return procedure
+
+
+class _Gimp:
+
+    Image = Image
+    Layer = Layer
+    GroupLayer = GroupLayer
+    Display = Display
+
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(prefix="fanim-bench-")
+
+    def image_list(self):
+        _call()
+        return list(_images)
+
+    def displays_flush(self):
+        _call()
+
+    def message(self, text):
+        pass
+
+    def personal_rc_file(self, name):
+        return os.path.join(self.directory, name)
+
+
+pdb = _PDB()
+gimp = _Gimp()
+
+
+def register(*args, **kwargs):
+    pass
+
+
+def main():
+    pass
+
+
+def make_image(frames, width=64, height=64, fixed_every=0):
+    """
+    Return an image with frames layers named like FAnim frames, the first
+    one and then every fixed_every-th one being fixed frames.
+    """
+    image = Image(width, height, RGB)
+    for i in range(frames):
+        name = "Frame %d" % i
+        if fixed_every and i % fixed_every == 0:
+            name += "_fix"
+        image._layers.append(Layer(image, name, width, height))
+    if image._layers:
+        image._active = image._layers[0]
+    # in timeline order already, like images saved by this version.
+    image._parasites["fanim-order"] = Parasite("fanim-order", PARASITE_PERSISTENT, "bottom-up")
+    image._dirty = 0
+    return image
@@ -15,13 +15,29 @@ frame by frame animation.
 """
 
 from gimpfu import register, main, gimp, pdb, \
-        TRANSPARENT_FILL, RGBA_IMAGE, NORMAL_MODE
+        TRANSPARENT_FILL, RGB, RGBA_IMAGE, NORMAL_MODE, CLIP_TO_IMAGE, PARASITE_PERSISTENT
 
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, GdkPixbuf
-
-import array, time, os, json
+from gi.repository import Gtk, Gdk, GdkPixbuf, GLib, GObject, Pango
+import cairo
+
+import array, time, os, io, json, math, bisect, platform, struct, zlib, hashlib
+import itertools, shutil, subprocess, tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# numpy is optional, the exports fall back to the slower PDB path without it.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Pillow is optional too, it encodes the frames of animated gif files.
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
 
 # general info
 VERSION = 1.16
@@ -37,6 +53,25 @@ GIMP_LOCATION = "<Image>/FAnim/FAnim Timeline"
 # fixed frames prefix in the end to store visibility fix for the playback understand.
 PREFIX = "_fix"
 
+# layer parasite holding how long a frame is shown, "3" for 3 ticks of the
+# framerate or "120ms" for a duration.
+HOLD_PARASITE = "fanim-hold"
+HOLD_MAX = 999
+HOLD_MAX_MS = 60000
+
+# index table of deduplicated spritesheets, JSON with the cell size, the
+# columns, the padding and the cell shown at every tick in "frames". It is
+# kept in an image parasite, and in a .json file when the user picks one,
+# since the parasite is lost once the sheet is saved as PNG.
+SHEET_INDEX_PARASITE = "fanim-sheet-index"
+SHEET_INDEX_SUFFIX = "-spritesheet"
+
+# image parasite telling the layer stack is in timeline order, the first
+# frame being the bottom layer. Older versions saved the first frame at the
+# top, images without it are reversed once if the user agrees.
+ORDER_PARASITE = "fanim-order"
+ORDER_BOTTOM_UP = "bottom-up"
+
 # playback macros
 NEXT = 1
 PREV = 2
@@ -56,16 +91,91 @@ OSKIN_DEPTH = "oskin_depth"
 OSKIN_ONPLAY = "oskin_onplay"
 OSKIN_FORWARD = "oskin_forward"
 OSKIN_BACKWARD = "oskin_backward"
+DROP_FRAMES = "drop_frames"
+PRERENDER = "prerender"
+SHOW_STATS = "show_stats"
+SHEET_COLUMNS = "sheet_columns"
+SHEET_PADDING = "sheet_padding"
+OSKIN_OVERLAY = "oskin_overlay"
+DEDUPE_FRAMES = "dedupe_frames"
+DEDUPE_TOLERANCE = "dedupe_tolerance"
+ATLAS_MAX_SIZE = "atlas_max_size"
+ATLAS_POT = "atlas_pot"
+OSKIN_FALLOFF = "oskin_falloff"
 
 # state to disable the buttons
 PLAYING = 1
 NO_FRAMES = 2
+EXPORTING = 3
+LOADING = 4
+
+# seconds of export work done per main loop iteration.
+EXPORT_SLICE = 0.05
+# milliseconds an export step waiting on something outside sleeps for.
+EXPORT_WAIT_MS = 20
+
+# rows of pixels written to a layer at a time.
+FILL_ROWS = 256
+
+# frames read from their layer per batch while the timeline opens.
+LOAD_BATCH = 16
+
+# texture atlas pages, default largest side in pixels.
+ATLAS_MAX_SIZE_DEFAULT = 2048
+
+# animated files saved straight from the timeline, alpha under this is
+# transparent in gif files.
+GIF_ALPHA_THRESHOLD = 128
+WEBP_ENCODER = "img2webp"
 
 # onionskin constants
 OSKIN_MAX_DEPTH = 6
 OSKIN_MAX_OPACITY = 50.0
+# opacity kept from one onion skin step to the next one, 0 for the classic
+# falloff of max opacity // step - 2.
+OSKIN_FALLOFF_DEFAULT = 0.0
+# tinted overlay: colors of the past and future frames, how much of the frame
+# color is replaced by the tint, and overlays kept for going back and forth.
+OSKIN_PAST_TINT = (255, 64, 64)
+OSKIN_FUTURE_TINT = (64, 128, 255)
+OSKIN_TINT_AMOUNT = 0.6
+OSKIN_CACHE_SIZE = 4
 
 CONF_FILENAME = "conf.json"
+PLAYBACK_LOG_FILENAME = "playback.jsonl"
+STARTUP_LOG_FILENAME = "startup.jsonl"
+# bytes a log grows to before it is rotated.
+LOG_MAX_SIZE = 256 * 1024
+
+# thumbnail cache
+THUMB_SIZE = 100
+THUMB_CACHE_SIZE = 1024
+# biggest thumbnail the PDB hands out.
+THUMB_MAX_SIZE = 1024
+# thumbnails kept on disk between sessions.
+THUMB_STORE_DIRNAME = "thumbnails"
+THUMB_STORE_BUDGET = 64 * 1024 * 1024
+
+# frame strip cells
+CELL_WIDTH = 104
+CELL_HEIGHT = 142
+CELL_LABEL_Y = 2
+CELL_THUMB_Y = 20
+CELL_FIX_Y = 122
+CELL_ICON_SIZE = 16
+# thumbnails loaded per idle call, and cells kept loaded around the view.
+THUMB_BATCH = 8
+THUMB_KEEP_MARGIN = 50
+
+# focus events closer than this are handled once, in milliseconds.
+FOCUS_DEBOUNCE = 150
+
+# pre-rendered playback preview
+PREVIEW_HEIGHT = 200
+# proxy frames are the canvas divided by one of these, and all the proxies
+# of the playable frames are kept under the budget, in bytes.
+PROXY_LEVELS = (1, 2, 4, 8)
+PROXY_CACHE_BUDGET = 512 * 1024 * 1024
 
 
 class Utils:
@@ -87,6 +197,43 @@ class Utils:
         name = layer.name
         return name[-4:] == PREFIX
 
+    @staticmethod
+    def get_hold(layer):
+        """Return (ticks, ms) stored on the layer, ms is None for tick holds."""
+        parasite = layer.parasite_find(HOLD_PARASITE)
+        if parasite is None:
+            return 1, None
+
+        data = parasite.data
+        if isinstance(data, bytes):
+            data = data.decode("ascii", "ignore")
+        data = data.strip()
+        try:
+            if data.endswith("ms"):
+                return 1, max(1, int(data[:-2]))
+            return max(1, int(data)), None
+        except ValueError:
+            return 1, None
+
+    @staticmethod
+    def set_hold(layer, ticks, ms=None):
+        if ms:
+            data = "%dms" % ms
+        elif ticks > 1:
+            data = "%d" % ticks
+        else:
+            if layer.parasite_find(HOLD_PARASITE) is not None:
+                layer.parasite_detach(HOLD_PARASITE)
+            return
+        layer.attach_new_parasite(HOLD_PARASITE, PARASITE_PERSISTENT, data)
+
+    @staticmethod
+    def layer_bytes(layer):
+        """Return the raw pixels of layer."""
+        w, h = layer.width, layer.height
+        rgn = layer.get_pixel_rgn(0, 0, w, h, False, False)
+        return rgn[0:w, 0:h]
+
     @staticmethod
     def button_stock(stock, size):
         """Return a button with an image from a named icon."""
@@ -118,6 +265,24 @@ class Utils:
         h.pack_start(b, True, True, 0)
         return h, adjustment
 
+    @staticmethod
+    def drawable_pixbuf(drawable, width, height):
+        """Return a pixbuf of the drawable scaled to fit width x height."""
+        image_data = pdb.gimp_drawable_thumbnail(drawable,
+                                                 min(width, THUMB_MAX_SIZE),
+                                                 min(height, THUMB_MAX_SIZE))
+
+        w, h, c, data = (image_data[0], image_data[1],
+                         image_data[2], image_data[4])
+
+        # data is already bytes in Python 3
+        image_array = array.array('B', data)
+
+        has_alpha = c > 3
+        colorspace = GdkPixbuf.Colorspace.RGB
+        return GdkPixbuf.Pixbuf.new_from_data(
+            image_array.tobytes(), colorspace, has_alpha, 8, w, h, w * c)
+
     @staticmethod
     def load_conffile(filename):
         directory = gimp.directory + "/fanim"
@@ -142,6 +307,945 @@ class Utils:
         with open(filepath, 'w') as f:
             json.dump(conf, f)
 
+    @staticmethod
+    def append_log(filename, record):
+        """
+        Append record as one JSON line to a log in the conf directory. A log
+        grown past LOG_MAX_SIZE is moved aside to a .1 file first, replacing
+        the previous one.
+        """
+        directory = gimp.directory + "/fanim"
+        if not os.path.exists(directory):
+            os.mkdir(directory)
+
+        filepath = directory + "/" + filename
+        if os.path.exists(filepath) and os.path.getsize(filepath) > LOG_MAX_SIZE:
+            os.replace(filepath, filepath + ".1")
+        with open(filepath, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+
+
+class Pixels:
+    """NumPy helpers to read, composite and write layer pixels."""
+
+    @staticmethod
+    def read(layer):
+        """Return the layer pixels as a (height, width, 4) RGBA array."""
+        w, h = layer.width, layer.height
+        rgn = layer.get_pixel_rgn(0, 0, w, h, False, False)
+        bpp = rgn.bpp
+        data = np.frombuffer(rgn[0:w, 0:h], dtype=np.uint8).reshape(h, w, bpp)
+
+        if layer.is_indexed:
+            colormap = pdb.gimp_image_get_colormap(layer.image)[1]
+            colormap = np.frombuffer(bytes(colormap), dtype=np.uint8).reshape(-1, 3)
+            color = colormap[data[..., 0]]
+        elif bpp < 3:
+            color = np.repeat(data[..., :1], 3, axis=2)
+        else:
+            color = data[..., :3]
+
+        out = np.empty((h, w, 4), dtype=np.uint8)
+        out[..., :3] = color
+        if bpp in (2, 4):
+            out[..., 3] = data[..., -1]
+        else:
+            out[..., 3] = 255
+        return out
+
+    @staticmethod
+    def over(dst, src, x=0, y=0):
+        """Paint src over dst with its top left corner at (x, y), in place."""
+        dh, dw = dst.shape[:2]
+        sh, sw = src.shape[:2]
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + sw, dw), min(y + sh, dh)
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        s = src[y0 - y:y1 - y, x0 - x:x1 - x].astype(np.float32) / 255.0
+        d = dst[y0:y1, x0:x1].astype(np.float32) / 255.0
+
+        sa = s[..., 3:]
+        da = d[..., 3:] * (1.0 - sa)
+        alpha = sa + da
+        color = (s[..., :3] * sa + d[..., :3] * da) / np.maximum(alpha, 1e-6)
+
+        out = np.concatenate((color, alpha), axis=2) * 255.0 + 0.5
+        dst[y0:y1, x0:x1] = out.astype(np.uint8)
+
+    @staticmethod
+    def bounds(data):
+        """Return the x, y, width, height of the non transparent pixels, None if none."""
+        alpha = data[..., 3]
+        rows = np.flatnonzero(alpha.any(axis=1))
+        if not rows.size:
+            return None
+        columns = np.flatnonzero(alpha.any(axis=0))
+        return (int(columns[0]), int(rows[0]),
+                int(columns[-1] - columns[0] + 1), int(rows[-1] - rows[0] + 1))
+
+    @staticmethod
+    def from_pixbuf(pixbuf):
+        """Return the pixels of a pixbuf as a (height, width, 4) RGBA array."""
+        w, h, c = pixbuf.get_width(), pixbuf.get_height(), pixbuf.get_n_channels()
+        stride = pixbuf.get_rowstride()
+        data = pixbuf.read_pixel_bytes().get_data()
+        # the last row is not padded to the rowstride.
+        data = np.frombuffer(data + bytes(h * stride - len(data)), dtype=np.uint8)
+        data = data.reshape(h, stride)[:, :w * c].reshape(h, w, c)
+        if c == 4:
+            return data.copy()
+        out = np.empty((h, w, 4), dtype=np.uint8)
+        out[..., :3] = data
+        out[..., 3] = 255
+        return out
+
+    @staticmethod
+    def pixbuf(data):
+        """Return an RGBA array as a pixbuf."""
+        h, w = data.shape[:2]
+        pixels = GLib.Bytes.new(np.ascontiguousarray(data).tobytes())
+        return GdkPixbuf.Pixbuf.new_from_bytes(pixels, GdkPixbuf.Colorspace.RGB,
+                                               True, 8, w, h, w * 4)
+
+    @staticmethod
+    def save_png(path, data):
+        """Write an RGBA array to a PNG file."""
+        Pixels.pixbuf(data).savev(path, "png", [], [])
+
+    @staticmethod
+    def shrink(data, factor):
+        """
+        Return data scaled down by an integer factor, averaging every
+        factor x factor block with its colors weighted by their alpha.
+        """
+        if factor == 1:
+            return data
+        h, w = data.shape[0] // factor, data.shape[1] // factor
+        if not h or not w:
+            return data[:1, :1].copy()
+
+        blocks = data[:h * factor, :w * factor].astype(np.float32)
+        blocks = blocks.reshape(h, factor, w, factor, 4)
+        alpha = blocks[..., 3:]
+        color = (blocks[..., :3] * alpha).sum(axis=(1, 3))
+        alpha = alpha.sum(axis=(1, 3))
+
+        out = np.empty((h, w, 4), dtype=np.uint8)
+        out[..., :3] = (color / np.maximum(alpha, 1e-6) + 0.5).clip(0, 255)
+        out[..., 3] = (alpha[..., 0] / (factor * factor) + 0.5).clip(0, 255)
+        return out
+
+    @staticmethod
+    def similar(a, b, tolerance):
+        """Whether a and b have the same shape and no channel apart by more than tolerance."""
+        if a.shape != b.shape:
+            return False
+        return int(np.abs(a.astype(np.int16) - b).max()) <= tolerance
+
+    @staticmethod
+    def write(image, name, data, position=0):
+        """Add data as a new RGBA layer of image and return the layer."""
+        h, w = data.shape[:2]
+        layer = gimp.Layer(image, name, w, h, RGBA_IMAGE, 100, NORMAL_MODE)
+        image.add_layer(layer, position)
+        Pixels.fill(layer, data)
+        return layer
+
+    @staticmethod
+    def fill(layer, data):
+        """
+        Replace the pixels of an RGBA layer of the same size as data, a few
+        rows at a time so data is never copied whole.
+        """
+        h, w = data.shape[:2]
+        rgn = layer.get_pixel_rgn(0, 0, w, h, True, False)
+        for y in range(0, h, FILL_ROWS):
+            rows = data[y:y + FILL_ROWS]
+            rgn[0:w, y:y + rows.shape[0]] = np.ascontiguousarray(rows).tobytes()
+        layer.flush()
+        layer.merge_shadow(True)
+        layer.update(0, 0, w, h)
+
+
+class MaxRects:
+    """
+    Rectangle bin packer keeping the maximal free rectangles of the bin and
+    placing each new one where it leaves the shortest side free (Jylänki's
+    MaxRects, best short side fit).
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.used_width = 0
+        self.used_height = 0
+        self._free = [(0, 0, width, height)]
+
+    def insert(self, width, height):
+        """Return the x, y where a width x height rectangle was put, None if it does not fit."""
+        best, score = None, None
+        for fx, fy, fw, fh in self._free:
+            if width <= fw and height <= fh:
+                s = (min(fw - width, fh - height), max(fw - width, fh - height))
+                if score is None or s < score:
+                    best, score = (fx, fy), s
+        if best is None:
+            return None
+
+        x, y = best
+        self._split(x, y, width, height)
+        self.used_width = max(self.used_width, x + width)
+        self.used_height = max(self.used_height, y + height)
+        return best
+
+    def _split(self, x, y, w, h):
+        free = []
+        for fx, fy, fw, fh in self._free:
+            if x >= fx + fw or x + w <= fx or y >= fy + fh or y + h <= fy:
+                free.append((fx, fy, fw, fh))
+                continue
+            if x > fx:
+                free.append((fx, fy, x - fx, fh))
+            if x + w < fx + fw:
+                free.append((x + w, fy, fx + fw - x - w, fh))
+            if y > fy:
+                free.append((fx, fy, fw, y - fy))
+            if y + h < fy + fh:
+                free.append((fx, y + h, fw, fy + fh - y - h))
+
+        # drop the free rectangles held by another one.
+        self._free = [a for i, a in enumerate(free)
+                      if not any(i != j and a[0] >= b[0] and a[1] >= b[1] and
+                                 a[0] + a[2] <= b[0] + b[2] and a[1] + a[3] <= b[1] + b[3] and
+                                 (a != b or j < i)
+                                 for j, b in enumerate(free))]
+
+
+class ApngWriter:
+    """
+    Animated PNG written one frame at a time. Every frame after the first
+    only stores the rectangle that changed, the frame count is written in
+    the header once the last frame is in.
+    """
+
+    SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+    def __init__(self, path, width, height):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.count = 0
+        self._previous = None
+        self._file = open(path, "wb")
+        self._file.write(self.SIGNATURE)
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+        self._actl = self._file.tell()
+        self._chunk(b"acTL", struct.pack(">II", 0, 0))
+
+    def _chunk(self, kind, data):
+        self._file.write(struct.pack(">I", len(data)) + kind + data)
+        self._file.write(struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+    def add(self, data, ms):
+        x, y, w, h = 0, 0, self.width, self.height
+        if self._previous is not None:
+            changed = np.any(data != self._previous, axis=2)
+            rows = np.flatnonzero(changed.any(axis=1))
+            if rows.size:
+                columns = np.flatnonzero(changed.any(axis=0))
+                x, y = int(columns[0]), int(rows[0])
+                w, h = int(columns[-1]) + 1 - x, int(rows[-1]) + 1 - y
+            else:
+                w, h = 1, 1
+        self._previous = data
+
+        # frame delay as a fraction, in milliseconds while it fits.
+        num, den = int(round(ms)), 1000
+        if num > 0xffff:
+            num, den = min(0xffff, int(round(ms / 10.0))), 100
+
+        seq = 2 * self.count - (1 if self.count else 0)
+        self._chunk(b"fcTL", struct.pack(">IIIIIHHBB", seq, w, h, x, y, num, den, 0, 0))
+
+        # every row with the "up" filter, as the difference to the one above.
+        rows = data[y:y + h, x:x + w].reshape(h, w * 4)
+        filtered = np.empty((h, w * 4 + 1), dtype=np.uint8)
+        filtered[:, 0] = 2
+        filtered[0, 1:] = rows[0]
+        filtered[1:, 1:] = rows[1:] - rows[:-1]
+        pixels = zlib.compress(filtered.tobytes(), 6)
+
+        if self.count:
+            self._chunk(b"fdAT", struct.pack(">I", seq + 1) + pixels)
+        else:
+            self._chunk(b"IDAT", pixels)
+        self.count += 1
+
+    def finish(self):
+        """Export steps writing the end of the file."""
+        self._chunk(b"IEND", b"")
+        self._file.seek(self._actl)
+        self._chunk(b"acTL", struct.pack(">II", self.count, 0))
+        self._file.close()
+        yield
+
+    def abort(self):
+        self._file.close()
+        os.remove(self.path)
+
+
+class GifWriter:
+    """
+    Animated gif written one frame at a time, each frame quantized and LZW
+    encoded by Pillow on its own with a local palette, the last index being
+    transparent. Needs Pillow.
+    """
+
+    def __init__(self, path, width, height):
+        self.path = path
+        self.width = width
+        self.height = height
+        self._elapsed = 0.0
+        self._written = 0
+        self._file = open(path, "wb")
+        self._file.write(b"GIF89a" + struct.pack("<HHBBB", width, height, 0, 0, 0))
+        # loop forever.
+        self._file.write(b"\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00")
+
+    def add(self, data, ms):
+        # gif delays are in hundredths of seconds, rounded on the running
+        # time so the errors do not add up.
+        self._elapsed += ms
+        delay = min(0xffff, int(round(self._elapsed / 10.0)) - self._written)
+        self._written += delay
+
+        h, w = data.shape[:2]
+        quantized = PILImage.fromarray(np.ascontiguousarray(data[..., :3])).quantize(255)
+        indexes = np.asarray(quantized, dtype=np.uint8).copy()
+        indexes[data[..., 3] < GIF_ALPHA_THRESHOLD] = 255
+        palette = (quantized.getpalette() or [])[:255 * 3]
+        palette += [0] * (768 - len(palette))
+
+        frame = PILImage.frombytes("P", (w, h), indexes.tobytes())
+        frame.putpalette(palette)
+        buf = io.BytesIO()
+        frame.save(buf, "GIF", transparency=255, optimize=False, interlace=False)
+        descriptor, table, pixels = self._split(buf.getvalue())
+
+        # graphic control: restore to background after the frame, transparent index.
+        self._file.write(b"\x21\xf9\x04" + struct.pack("<BHBB", (2 << 2) | 1, delay, 255, 0))
+        self._file.write(descriptor + table + pixels)
+
+    @staticmethod
+    def _split(gif):
+        """Return the image descriptor, its color table and the image data of a one frame gif."""
+        flags = gif[10]
+        pos = 13
+        table = b""
+        if flags & 0x80:
+            size = 3 << ((flags & 7) + 1)
+            table = gif[pos:pos + size]
+            pos += size
+
+        # skip the extensions, the gif is made of sub-blocks up to an empty one.
+        while gif[pos] == 0x21:
+            pos += 2
+            while gif[pos]:
+                pos += gif[pos] + 1
+            pos += 1
+
+        descriptor = bytearray(gif[pos:pos + 10])
+        pos += 10
+        if descriptor[9] & 0x80:
+            size = 3 << ((descriptor[9] & 7) + 1)
+            table = gif[pos:pos + size]
+            pos += size
+        else:
+            # the global palette becomes the local one of the frame.
+            descriptor[9] = (descriptor[9] & 0x40) | 0x80 | (flags & 7)
+        return bytes(descriptor), table, gif[pos:gif.rindex(b"\x3b")]
+
+    def finish(self):
+        """Export steps writing the end of the file."""
+        self._file.write(b"\x3b")
+        self._file.close()
+        yield
+
+    def abort(self):
+        self._file.close()
+        os.remove(self.path)
+
+
+class WebpWriter:
+    """
+    Animated WebP made by the img2webp command line encoder, from frames
+    written one at a time as PNG files to a temporary directory. The frames
+    are listed in an argument file there, as a long animation would not fit
+    on a command line; names are relative to it so none has a space.
+    """
+
+    ARGS_FILENAME = "args.txt"
+    OUTPUT_FILENAME = "out.webp"
+    ERRORS_FILENAME = "errors.txt"
+
+    def __init__(self, path, width, height):
+        self.path = path
+        self.directory = tempfile.mkdtemp(prefix="fanim-")
+        self.count = 0
+        self._args = ["-loop", "0"]
+        self._process = None
+
+    @staticmethod
+    def available():
+        return shutil.which(WEBP_ENCODER) is not None
+
+    def add(self, data, ms):
+        name = "%06d.png" % self.count
+        Pixels.save_png(os.path.join(self.directory, name), data)
+        self._args += ["-d", str(max(1, int(round(ms)))), name]
+        self.count += 1
+
+    def finish(self):
+        """Export steps running the encoder, waiting on it between checks."""
+        with open(os.path.join(self.directory, self.ARGS_FILENAME), "w") as f:
+            f.write("\n".join(self._args + ["-o", self.OUTPUT_FILENAME]) + "\n")
+
+        try:
+            # a file can't fill up and block the encoder like a pipe.
+            with open(os.path.join(self.directory, self.ERRORS_FILENAME), "w+b") as errors:
+                self._process = subprocess.Popen(
+                    [shutil.which(WEBP_ENCODER), self.ARGS_FILENAME], cwd=self.directory,
+                    stdout=subprocess.DEVNULL, stderr=errors)
+                while self._process.poll() is None:
+                    yield ExportJob.WAIT
+                if self._process.returncode != 0:
+                    errors.seek(0)
+                    raise IOError(errors.read().decode("utf-8", "replace").strip() or
+                                  "%s exited with %d" % (WEBP_ENCODER, self._process.returncode))
+            shutil.move(os.path.join(self.directory, self.OUTPUT_FILENAME), self.path)
+            yield
+        finally:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def abort(self):
+        if self._process is not None and self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ThumbnailStore:
+    """
+    Thumbnails kept on disk between sessions, in one file per image file
+    under the fanim conf directory. They are only used while the image is
+    clean and its file did not change since they were written: the store is
+    per file, saving the image drops all of its thumbnails.
+
+    File layout: a header (magic, version, file mtime, file size, count)
+    followed by count records of (tattoo, width, height, channels,
+    rowstride, length) and length bytes of zlib'd pixels.
+    """
+
+    MAGIC = b"FANT"
+    VERSION = 2
+    HEADER = struct.Struct("<4sBqqI")
+    RECORD = struct.Struct("<IHHBII")
+
+    def __init__(self, image, budget=THUMB_STORE_BUDGET):
+        self.image = image
+        self.budget = budget
+        self.directory = gimp.directory + "/fanim/" + THUMB_STORE_DIRNAME
+        self.path = None
+        if image.filename:
+            name = hashlib.sha1(os.path.abspath(image.filename).encode("utf-8")).hexdigest()
+            self.path = self.directory + "/" + name + ".thumbs"
+
+    def _file_stat(self):
+        try:
+            st = os.stat(self.image.filename)
+        except (OSError, TypeError):
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def load(self):
+        """Return {tattoo: pixbuf} of the stored thumbnails still valid."""
+        stat = self._file_stat()
+        if self.path is None or stat is None or not os.path.exists(self.path):
+            return {}
+        if pdb.gimp_image_is_dirty(self.image):
+            return {}
+
+        thumbs = {}
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+            magic, version, mtime, size, count = self.HEADER.unpack_from(data, 0)
+            if magic != self.MAGIC or version != self.VERSION or (mtime, size) != stat:
+                return {}
+
+            offset = self.HEADER.size
+            for _ in range(count):
+                tattoo, w, h, c, stride, length = self.RECORD.unpack_from(data, offset)
+                offset += self.RECORD.size
+                chunk = data[offset:offset + length]
+                offset += length
+
+                pixels = GLib.Bytes.new(zlib.decompress(chunk))
+                thumbs[tattoo] = GdkPixbuf.Pixbuf.new_from_bytes(
+                    pixels, GdkPixbuf.Colorspace.RGB, c > 3, 8, w, h, stride)
+
+            # keeps recently used images away from the budget trimming.
+            os.utime(self.path, None)
+        except (IOError, OSError, struct.error, zlib.error):
+            return {}
+        return thumbs
+
+    def save(self, thumbs):
+        """Write {tattoo: pixbuf} for the image, then trim the store."""
+        stat = self._file_stat()
+        if self.path is None or stat is None or not thumbs:
+            return
+        if pdb.gimp_image_is_dirty(self.image):
+            return
+
+        chunks = [self.HEADER.pack(self.MAGIC, self.VERSION, stat[0], stat[1], len(thumbs))]
+        for tattoo, pixbuf in thumbs.items():
+            pixels = zlib.compress(pixbuf.read_pixel_bytes().get_data(), 6)
+            chunks.append(self.RECORD.pack(tattoo, pixbuf.get_width(), pixbuf.get_height(),
+                                           pixbuf.get_n_channels(), pixbuf.get_rowstride(),
+                                           len(pixels)))
+            chunks.append(pixels)
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(b"".join(chunks))
+        os.replace(tmp, self.path)
+        self.trim()
+
+    def trim(self):
+        """Delete the least recently used files while over the budget."""
+        files = []
+        for name in os.listdir(self.directory):
+            path = self.directory + "/" + name
+            st = os.stat(path)
+            files.append((st.st_mtime, st.st_size, path))
+
+        total = sum(f[1] for f in files)
+        for mtime, size, path in sorted(files):
+            if total <= self.budget:
+                break
+            os.remove(path)
+            total -= size
+
+
+class ThumbnailCache:
+    """
+    LRU cache of layer thumbnails, so unchanged layers are not fetched
+    again from the PDB every time the timeline rescans the image.
+
+    Entries are keyed by the layer ID and validated against a revision made
+    of the layer size and a counter per layer. GIMP has no per-drawable
+    change counter and its dirty flag is cleared by saving, so the timeline
+    calls expire() each time it gets the focus back: after that, the first
+    use of a layer fetches its thumbnail again and bumps its counter when
+    the pixels differ from the ones seen before. Only the edited layers
+    count as changed then, edits too small to show in a thumbnail are not
+    noticed. The same revision keys the playback proxies and the onion skin.
+
+    Thumbnails preloaded from a ThumbnailStore, keyed by tattoo, are used
+    for layers that were not checked yet before fetching from the PDB.
+    """
+
+    def __init__(self, size=THUMB_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        # track tattoos of the cached layers, to save them to a store.
+        self.persist = False
+        self._entries = OrderedDict()
+        self._revisions = {}
+        self._epoch = 0
+        # layer ID: (epoch, digest) of the last thumbnail seen of the layer.
+        self._checked = {}
+        self._tattoos = {}
+        self._preloaded = {}
+
+    def preload(self, thumbs):
+        self._preloaded = thumbs
+
+    def revision(self, layer):
+        """Change counter and size of layer, checked once per expire()."""
+        return (self.edits(layer), layer.width, layer.height)
+
+    def edits(self, layer):
+        """Change counter of layer, checked once per expire(), without the size."""
+        self._check(layer)
+        return self._revisions.get(layer.ID, 0)
+
+    def invalidate(self, layer):
+        self._revisions[layer.ID] = self._revisions.get(layer.ID, 0) + 1
+
+    def expire(self):
+        """Check every layer again on its next use, drop the preloaded thumbnails."""
+        self._epoch += 1
+        self._preloaded = {}
+
+    def current(self, layer):
+        """Whether the cached thumbnail of layer is still valid, without PDB calls."""
+        key = layer.ID
+        entry = self._entries.get(key)
+        checked = self._checked.get(key)
+        return (entry is not None and checked is not None and checked[0] == self._epoch and
+                entry[0][0] == self._revisions.get(key, 0))
+
+    @staticmethod
+    def _digest(pixbuf):
+        digest = hashlib.blake2b(struct.pack("<3i", pixbuf.get_width(), pixbuf.get_height(),
+                                             pixbuf.get_n_channels()), digest_size=16)
+        digest.update(pixbuf.read_pixel_bytes().get_data())
+        return digest.digest()
+
+    def _check(self, layer):
+        """
+        Compare layer with the last thumbnail seen of it once per expire(),
+        bumping its counter when they differ. Return the thumbnail fetched
+        for that, None when it was already checked.
+        """
+        key = layer.ID
+        checked = self._checked.get(key)
+        if checked is not None and checked[0] == self._epoch:
+            return None
+
+        pixbuf = Utils.drawable_pixbuf(layer, THUMB_SIZE, THUMB_SIZE)
+        digest = self._digest(pixbuf)
+        if checked is not None and checked[1] != digest:
+            self.invalidate(layer)
+        self._checked[key] = (self._epoch, digest)
+        return pixbuf
+
+    def get(self, layer):
+        """Return a pixbuf thumbnail of layer, fetching it only on a miss."""
+        key = layer.ID
+        pixbuf = None
+        if key not in self._checked and key not in self._revisions and self._preloaded:
+            self._tattoos[key] = layer.tattoo
+            pixbuf = self._preloaded.pop(self._tattoos[key], None)
+            if pixbuf is not None:
+                self.disk_hits += 1
+                self._checked[key] = (self._epoch, self._digest(pixbuf))
+        if pixbuf is None:
+            pixbuf = self._check(layer)
+
+        rev = (self._revisions.get(key, 0), layer.width, layer.height)
+        entry = self._entries.get(key)
+        if pixbuf is None and entry is not None and entry[0] == rev:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        if pixbuf is None:
+            # invalidated or resized since the check.
+            pixbuf = Utils.drawable_pixbuf(layer, THUMB_SIZE, THUMB_SIZE)
+            self._checked[key] = (self._epoch, self._digest(pixbuf))
+        if self.persist and key not in self._tattoos:
+            self._tattoos[key] = layer.tattoo
+
+        self._entries[key] = (rev, pixbuf)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+        return pixbuf
+
+    def persistent(self, layers):
+        """
+        Return {tattoo: pixbuf} of the cached thumbnails of layers, each one
+        checked against its layer first so that none saved is stale.
+        """
+        thumbs = {}
+        for layer in layers:
+            key = layer.ID
+            entry = self._entries.get(key)
+            if entry is None or key not in self._tattoos:
+                continue
+            pixbuf = self._check(layer)
+            if pixbuf is None:
+                if entry[0][0] != self._revisions.get(key, 0):
+                    continue
+                pixbuf = entry[1]
+            thumbs[self._tattoos[key]] = pixbuf
+        return thumbs
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "disk_hits": self.disk_hits,
+                "entries": len(self._entries), "size": self.size}
+
+
+class PlaybackCache:
+    """
+    Proxies of the playable frames, flattened once with their fixed frames
+    composited in, at the canvas size divided by one of PROXY_LEVELS picked
+    from the preview size. Playing from it does not touch the image, so GIMP
+    does not have to re-composite the full canvas on every tick. The proxies
+    of every level used are kept while they fit the memory budget, so
+    resizing the preview does not render them again.
+    """
+
+    def __init__(self, timeline, budget=PROXY_CACHE_BUDGET):
+        self.timeline = timeline
+        self.budget = budget
+        self.level = None
+        self.width = 0
+        self.height = 0
+        self.scale = 1.0
+        # layer pixbufs of the level being rendered, only the fixed ones
+        # are kept between two prepare calls.
+        self._layers = {}
+        # level: {layer ID: (signature, pixbuf)}, the least recent first.
+        self._levels = OrderedDict()
+        self._frames = {}
+
+    def pick_level(self, width, height, count):
+        """
+        Return the largest level whose proxies of count frames still cover
+        a width x height preview, or the smallest one fitting the budget.
+        """
+        image = self.timeline.image
+        iw, ih = image.width, image.height
+        fit = min(float(width) / iw, float(height) / ih)
+
+        level = PROXY_LEVELS[0]
+        for d in PROXY_LEVELS:
+            if d * fit <= 1.0:
+                level = d
+        for d in PROXY_LEVELS:
+            if d >= level and (d == PROXY_LEVELS[-1] or
+                               count * (iw // d) * (ih // d) * 4 <= self.budget):
+                return d
+        return level
+
+    def prepare(self, width, height):
+        """
+        Export steps rendering again only the playable frames whose layers
+        changed, as told by their thumbnail revisions: after a focus change
+        that costs one thumbnail per layer instead of rendering every proxy
+        again. A step per layer checked and per proxy.
+        """
+        frames = self.timeline.frames
+        fixed = [i for i, f in enumerate(frames) if f.fixed]
+
+        image = self.timeline.image
+        level = self.pick_level(width, height, len(frames) - len(fixed))
+        if level != self.level:
+            self._layers.clear()
+            self.level = level
+            self.width = max(1, image.width // level)
+            self.height = max(1, image.height // level)
+            self.scale = 1.0 / level
+        self._frames = self._levels.setdefault(level, {})
+        self._levels.move_to_end(level)
+        yield 2 * len(frames) - len(fixed)
+
+        revisions = {}
+        for f in frames:
+            revisions[f.layer.ID] = self.timeline.thumbnails.revision(f.layer)
+            yield
+
+        for i, f in enumerate(frames):
+            if f.fixed:
+                continue
+            stack = ([frames[j] for j in fixed if j < i] + [f] +
+                     [frames[j] for j in fixed if j > i])
+            signature = tuple((x.layer.ID, revisions[x.layer.ID]) for x in stack)
+
+            entry = self._frames.get(f.layer.ID)
+            if entry is None or entry[0] != signature:
+                pixbuf = self._render(stack, revisions)
+                self._frames[f.layer.ID] = (signature, pixbuf)
+                # a frame's own layer is not part of any other proxy.
+                self._layers.pop(f.layer.ID, None)
+            yield
+
+        for cache in [self._layers] + list(self._levels.values()):
+            for key in [k for k in cache if k not in revisions]:
+                del cache[key]
+        self._trim()
+
+    def _trim(self):
+        """Drop the proxies of the least recent levels beyond the budget."""
+        def size(frames):
+            return sum(p.get_rowstride() * p.get_height() for s, p in frames.values())
+
+        total = sum(size(frames) for frames in self._levels.values())
+        for level in list(self._levels):
+            if total <= self.budget or level == self.level:
+                break
+            total -= size(self._levels.pop(level))
+
+    def get(self, frame):
+        entry = self._frames.get(frame.layer.ID)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def _layer_pixbuf(self, layer, revision):
+        entry = self._layers.get(layer.ID)
+        if entry is not None and entry[0] == revision:
+            return entry[1]
+
+        w = max(1, int(round(layer.width * self.scale)))
+        h = max(1, int(round(layer.height * self.scale)))
+        if np is not None and max(w, h) > THUMB_MAX_SIZE:
+            # bigger than the PDB thumbnails, scale the pixels down here.
+            pixbuf = Pixels.pixbuf(Pixels.shrink(Pixels.read(layer), self.level))
+        else:
+            pixbuf = Utils.drawable_pixbuf(layer, w, h)
+        if pixbuf.get_width() != w or pixbuf.get_height() != h:
+            pixbuf = pixbuf.scale_simple(w, h, GdkPixbuf.InterpType.BILINEAR)
+
+        self._layers[layer.ID] = (revision, pixbuf)
+        return pixbuf
+
+    def _render(self, stack, revisions):
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.width, self.height)
+        cr = cairo.Context(surface)
+
+        # stack goes from the bottom to the top.
+        for f in stack:
+            pixbuf = self._layer_pixbuf(f.layer, revisions[f.layer.ID])
+            x, y = f.layer.offsets
+            Gdk.cairo_set_source_pixbuf(cr, pixbuf, x * self.scale, y * self.scale)
+            cr.paint()
+
+        return Gdk.pixbuf_get_from_surface(surface, 0, 0, self.width, self.height)
+
+
+class OnionSkin:
+    """
+    Tinted onion skin drawn in the timeline preview only: the active frame
+    over one overlay of its neighbours, past frames in red and future ones
+    in blue. It is composited at the preview size from the layer
+    thumbnails, the image itself keeping the classic onion skin. The
+    overlays and the pixels of the frames they are made of are cached, and
+    only rebuilt when a contributing layer was invalidated.
+    """
+
+    def __init__(self, timeline):
+        self.timeline = timeline
+        self._shown = None
+        self._pixels = OrderedDict()
+        self._overlays = OrderedDict()
+
+    def show(self, active, neighbours):
+        """
+        Show in the preview the active frame over the overlay of neighbours,
+        a list of (frame, opacity, past).
+        """
+        image = self.timeline.image
+        edits = self.timeline.thumbnails.edits
+        size = (image.width, image.height)
+        key = (size, active.layer.ID, edits(active.layer)) + \
+            tuple((f.layer.ID, edits(f.layer), o, past) for f, o, past in neighbours)
+        if self._shown == key:
+            return
+
+        pixbuf = self._overlays.get(key)
+        if pixbuf is None:
+            scale = min(1.0, PREVIEW_HEIGHT / float(size[1]))
+            width, height = (max(1, int(round(n * scale))) for n in size)
+            pixbuf = Pixels.pixbuf(self._compose(active, neighbours, width, height, scale))
+            self._overlays[key] = pixbuf
+            while len(self._overlays) > OSKIN_CACHE_SIZE:
+                self._overlays.popitem(last=False)
+        self._overlays.move_to_end(key)
+
+        self.timeline.preview.show_pixbuf(pixbuf)
+        self._shown = key
+
+    def hide(self):
+        """Take the onion skin out of the preview, if it is the one shown there."""
+        if self._shown is not None:
+            self.timeline.preview.show_pixbuf(None)
+            self._shown = None
+
+    def clear(self):
+        self._pixels.clear()
+        self._overlays.clear()
+
+    def _layer_pixels(self, layer, scale):
+        """Return the offsets and the pixels of layer scaled down by scale."""
+        edits = self.timeline.thumbnails.edits(layer)
+        entry = self._pixels.get(layer.ID)
+        if entry is None or entry[:2] != (edits, scale):
+            x, y = layer.offsets
+            width = max(1, int(round(layer.width * scale)))
+            height = max(1, int(round(layer.height * scale)))
+            data = Pixels.from_pixbuf(Utils.drawable_pixbuf(layer, width, height))
+            entry = (edits, scale, (int(round(x * scale)), int(round(y * scale))), data)
+            self._pixels[layer.ID] = entry
+            while len(self._pixels) > 2 * OSKIN_MAX_DEPTH + 2:
+                self._pixels.popitem(last=False)
+        self._pixels.move_to_end(layer.ID)
+        return entry[2], entry[3]
+
+    def _compose(self, active, neighbours, width, height, scale):
+        overlay = np.zeros((height, width, 4), dtype=np.uint8)
+
+        # the nearest frames are painted last, over the farther ones.
+        for frame, opacity, past in reversed(neighbours):
+            (x, y), data = self._layer_pixels(frame.layer, scale)
+            tint = np.array(OSKIN_PAST_TINT if past else OSKIN_FUTURE_TINT, dtype=np.float32)
+
+            src = np.empty(data.shape, dtype=np.uint8)
+            color = data[..., :3] * (1.0 - OSKIN_TINT_AMOUNT) + tint * OSKIN_TINT_AMOUNT
+            src[..., :3] = color.astype(np.uint8)
+            src[..., 3] = (data[..., 3] * (opacity / 100.0)).astype(np.uint8)
+            Pixels.over(overlay, src, x, y)
+
+        (x, y), data = self._layer_pixels(active.layer, scale)
+        Pixels.over(overlay, data, x, y)
+        return overlay
+
+
+class PreviewArea(Gtk.DrawingArea):
+    """Lightweight widget showing the pre-rendered playback frames."""
+
+    def __init__(self, height=PREVIEW_HEIGHT):
+        super().__init__()
+        self.set_size_request(-1, height)
+        self.pixbuf = None
+        self.connect("draw", self.on_draw)
+
+    def show_pixbuf(self, pixbuf):
+        self.pixbuf = pixbuf
+        self.queue_draw()
+
+    def on_draw(self, widget, cr):
+        if self.pixbuf is None:
+            return False
+        alloc = self.get_allocation()
+        pw, ph = self.pixbuf.get_width(), self.pixbuf.get_height()
+
+        # proxies are at least as big as the preview, scale them to fit.
+        scale = min(float(alloc.width) / pw, float(alloc.height) / ph)
+        cr.translate((alloc.width - pw * scale) / 2.0, (alloc.height - ph * scale) / 2.0)
+        cr.scale(scale, scale)
+        Gdk.cairo_set_source_pixbuf(cr, self.pixbuf, 0, 0)
+        cr.get_source().set_filter(cairo.FILTER_GOOD)
+        cr.paint()
+        return False
+
 
 class ConfDialog(Gtk.Dialog):
     """Configuration dialog."""
@@ -172,18 +1276,37 @@ class ConfDialog(Gtk.Dialog):
 
         f_time = Gtk.Frame(label="Time")
         f_oskin = Gtk.Frame(label="Onion Skin")
+        f_sheet = Gtk.Frame(label="Spritesheet")
+        f_dedupe = Gtk.Frame(label="Duplicate Frames")
         self.set_size_request(300, -1)
 
         content = self.get_content_area()
         content.pack_start(f_time, True, True, h_space)
         content.pack_start(f_oskin, True, True, h_space)
+        content.pack_start(f_sheet, True, True, h_space)
+        content.pack_start(f_dedupe, True, True, h_space)
 
         # Time settings
         th = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
         fps, fps_spin = Utils.spin_button("Framerate", 'int',
                                           self.last_config[FRAMERATE], 1, 100)
+        drop = Gtk.CheckButton(label="Drop late frames")
+        drop.set_active(self.last_config[DROP_FRAMES])
+        drop.set_tooltip_text("skip frames that missed their time instead of showing them late.")
         th.pack_start(fps, True, True, h_space)
-        f_time.add(th)
+        th.pack_start(drop, True, True, h_space)
+
+        th2 = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
+        prerender = Gtk.CheckButton(label="Play proxies in preview")
+        prerender.set_active(self.last_config[PRERENDER])
+        prerender.set_tooltip_text("play pre-rendered 1/2, 1/4 or 1/8 size frames in the timeline "
+                                   "instead of the canvas, for big images.")
+        th2.pack_start(prerender, True, True, h_space)
+
+        tv = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        tv.pack_start(th, True, True, 0)
+        tv.pack_start(th2, True, True, 0)
+        f_time.add(tv)
 
         # Onion skin settings
         ov = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
@@ -210,12 +1333,83 @@ class ConfDialog(Gtk.Dialog):
         oh2.pack_start(backward, True, True, h_space)
         ov.pack_start(oh2, True, True, 0)
 
+        oh3 = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
+        falloff, falloff_spin = Utils.spin_button("Falloff", 'float',
+                                                  self.last_config[OSKIN_FALLOFF],
+                                                  0.0, 1.0, 0.05)
+        falloff.set_tooltip_text("opacity kept from one onion skin frame to the next one, "
+                                 "0 for the classic falloff.")
+        overlay = Gtk.CheckButton(label="Tinted preview")
+        overlay.set_active(self.last_config[OSKIN_OVERLAY])
+        overlay.set_sensitive(np is not None)
+        overlay.set_tooltip_text("also draw the onion skin in the timeline preview, past frames "
+                                 "in red and future frames in blue. The tint is only shown in "
+                                 "the preview (needs numpy).")
+
+        oh3.pack_start(falloff, True, True, h_space)
+        oh3.pack_start(overlay, True, True, h_space)
+        ov.pack_start(oh3, True, True, 0)
+
+        # Spritesheet settings
+        sh = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
+        columns, columns_spin = Utils.spin_button("Columns", 'int',
+                                                  self.last_config[SHEET_COLUMNS],
+                                                  0, 1000, 1)
+        padding, padding_spin = Utils.spin_button("Padding", 'int',
+                                                  self.last_config[SHEET_PADDING],
+                                                  0, 256, 1)
+        columns.set_tooltip_text("cells per row, 0 puts every frame in a single row.")
+        sh.pack_start(columns, True, True, h_space)
+        sh.pack_start(padding, True, True, h_space)
+
+        sh2 = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
+        max_size, max_size_spin = Utils.spin_button("Atlas page", 'int',
+                                                    self.last_config[ATLAS_MAX_SIZE],
+                                                    64, 16384, 64)
+        max_size.set_tooltip_text("largest side of the texture atlas pages.")
+        pot = Gtk.CheckButton(label="Power of two")
+        pot.set_active(self.last_config[ATLAS_POT])
+        pot.set_tooltip_text("round the texture atlas pages up to power of two sizes.")
+        sh2.pack_start(max_size, True, True, h_space)
+        sh2.pack_start(pot, True, True, h_space)
+
+        sv = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        sv.pack_start(sh, True, True, 0)
+        sv.pack_start(sh2, True, True, 0)
+        f_sheet.add(sv)
+
+        # Duplicate frames settings
+        dh = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
+        dedupe = Gtk.CheckButton(label="Merge duplicates")
+        dedupe.set_active(self.last_config[DEDUPE_FRAMES])
+        dedupe.set_tooltip_text("export identical frames once: following ones lengthen the gif "
+                                "frame, spritesheets get one cell each and an index table.")
+        tolerance, tolerance_spin = Utils.spin_button("Tolerance", 'int',
+                                                      self.last_config[DEDUPE_TOLERANCE],
+                                                      0, 255, 1)
+        tolerance.set_sensitive(np is not None)
+        tolerance.set_tooltip_text("largest channel difference for frames to count as the "
+                                   "same as the previous one (needs numpy).")
+        dh.pack_start(dedupe, True, True, h_space)
+        dh.pack_start(tolerance, True, True, h_space)
+        f_dedupe.add(dh)
+
         # Connect callbacks
         fps_spin.connect("value_changed", self.update_config, FRAMERATE)
+        drop.connect("toggled", self.update_config, DROP_FRAMES)
+        prerender.connect("toggled", self.update_config, PRERENDER)
         depth_spin.connect("value_changed", self.update_config, OSKIN_DEPTH)
         on_play.connect("toggled", self.update_config, OSKIN_ONPLAY)
         forward.connect("toggled", self.update_config, OSKIN_FORWARD)
         backward.connect("toggled", self.update_config, OSKIN_BACKWARD)
+        falloff_spin.connect("value_changed", self.update_config, OSKIN_FALLOFF)
+        overlay.connect("toggled", self.update_config, OSKIN_OVERLAY)
+        columns_spin.connect("value_changed", self.update_config, SHEET_COLUMNS)
+        padding_spin.connect("value_changed", self.update_config, SHEET_PADDING)
+        max_size_spin.connect("value_changed", self.update_config, ATLAS_MAX_SIZE)
+        pot.connect("toggled", self.update_config, ATLAS_POT)
+        dedupe.connect("toggled", self.update_config, DEDUPE_FRAMES)
+        tolerance_spin.connect("value_changed", self.update_config, DEDUPE_TOLERANCE)
 
         self.show_all()
 
@@ -229,122 +1423,575 @@ class ConfDialog(Gtk.Dialog):
         return result, conf
 
 
-class Player():
-    """Loop to play frames in sequence without freezing the UI."""
-
-    def __init__(self, timeline, play_button):
-        self.timeline = timeline
-        self.play_button = play_button
-        self.cnt = 0
+class PlaybackStats():
+    """Per tick timings of one playback session."""
+
+    def __init__(self):
+        self.started = time.time()
+        self._timings = OrderedDict()
+
+    def add(self, name, seconds):
+        t = self._timings.setdefault(name, [0, 0.0, 0.0])
+        t[0] += 1
+        t[1] += seconds
+        t[2] = max(t[2], seconds)
+
+    def mean_ms(self, name):
+        t = self._timings.get(name)
+        if not t:
+            return 0.0
+        return t[1] / t[0] * 1000.0
+
+    def text(self):
+        return "  ".join("%s %.1fms" % (name, self.mean_ms(name))
+                         for name in self._timings)
+
+    def record(self, player):
+        """Return the session as a dict for the playback log."""
+        timeline = player.timeline
+        return {
+            "started": self.started,
+            "seconds": time.time() - self.started,
+            "host": platform.node(),
+            "platform": platform.platform(),
+            "image": timeline.image.name,
+            "width": timeline.image.width,
+            "height": timeline.image.height,
+            "frames": len(timeline.frames),
+            "mode": "preview" if timeline.prerender else "canvas",
+            "target_fps": timeline.framerate,
+            "achieved_fps": round(player.achieved_fps(), 3),
+            "shown": player.cnt,
+            "dropped": player.dropped,
+            "late": player.late,
+            "timings_ms": {name: {"count": t[0],
+                                  "mean": round(t[1] / t[0] * 1000.0, 3),
+                                  "max": round(t[2] * 1000.0, 3)}
+                           for name, t in self._timings.items()},
+        }
+
+
+class ExportJob:
+    """
+    Export run a little at a time from the GLib main loop, so the timeline
+    stays responsive while it builds. steps is a generator yielding once per
+    unit of work, total units in all, or yielding a number to set a better
+    estimate of the total; closing it on cancel lets its finally clauses
+    delete what it created. on_finish(job, completed) is called once the job
+    ends, whatever the reason. Errors are shown to the user as title failing.
+    A step waiting on something outside yields WAIT, which ends the slice
+    and resumes the job EXPORT_WAIT_MS later instead of on the next idle.
+    """
+
+    WAIT = object()
+
+    def __init__(self, steps, total, progress, on_finish, title="The export"):
+        self.steps = steps
+        self.title = title
+        self.total = max(1, total)
+        self.done = 0
+        self.result = None
+        self.progress = progress
+        self.on_finish = on_finish
+        self.started = None
+        self._source = None
 
     def start(self):
-        while self.timeline.is_playing:
-            self.timeline.on_goto(None, NEXT)
+        self.started = time.monotonic()
+        self._report()
+        self._source = GLib.idle_add(self._run)
 
-            # skip fixed frames
-            while (self.timeline.frames[self.timeline.active].fixed and
-                   self.timeline.active < len(self.timeline.frames)):
-                self.timeline.on_goto(None, NEXT)
+    def cancel(self):
+        if self._source is None:
+            return
+        GLib.source_remove(self._source)
+        self._source = None
+        self.steps.close()
+        self.on_finish(self, False)
+
+    def remaining(self):
+        """Estimated seconds left, None until some work was done."""
+        if not self.done:
+            return None
+        elapsed = time.monotonic() - self.started
+        return elapsed * max(0, self.total - self.done) / self.done
 
-            if (not self.timeline.is_replay and
-                    self.timeline.active == len(self.timeline.frames) - 1):
-                self.timeline.on_toggle_play(self.play_button)
+    def _run(self):
+        deadline = time.monotonic() + EXPORT_SLICE
+        try:
+            while time.monotonic() < deadline:
+                total = next(self.steps)
+                if total is None:
+                    self.done += 1
+                elif total is self.WAIT:
+                    self._report()
+                    self._source = GLib.timeout_add(EXPORT_WAIT_MS, self._run)
+                    return False
+                else:
+                    self.total = max(1, total)
+        except StopIteration as stop:
+            self.result = stop.value
+            self._source = None
+            self.on_finish(self, True)
+            return False
+        except Exception as e:
+            # nothing above a GLib callback would catch it.
+            self._source = None
+            gimp.message("%s failed: %s" % (self.title, e))
+            self.on_finish(self, False)
+            return False
+
+        self._report()
+        return True
+
+    def _report(self):
+        self.progress.set_fraction(min(1.0, self.done / float(self.total)))
+        text = "%d/%d" % (min(self.done, self.total), self.total)
+        left = self.remaining()
+        if left is not None:
+            text += ", %d:%02d left" % divmod(int(left + 0.5), 60)
+        self.progress.set_text(text)
 
-            time.sleep(1.0 / self.timeline.framerate)
 
-            # process pending GTK events
-            while Gtk.events_pending():
-                Gtk.main_iteration()
+class Player():
+    """
+    Play frames in sequence from the GLib main loop without freezing the UI.
 
+    Every frame is aimed at an absolute deadline counted from the start of
+    the playback, so the time spent showing a frame does not pile up on top
+    of the frame period. Frames that miss their deadline are either dropped
+    to keep the animation in time or held late to show every frame.
+    """
 
-class AnimFrame(Gtk.EventBox):
-    """A frame representation widget for GTK."""
+    def __init__(self, timeline, play_button):
+        self.timeline = timeline
+        self.play_button = play_button
+        self.cnt = 0
+        self.late = 0
+        self.dropped = 0
+        self.position = 0
 
-    def __init__(self, layer, width=100, height=120):
-        super().__init__()
-        self.set_size_request(width, height)
+        self.stats = None
 
-        self.thumbnail = None
-        self.label = None
+        self._ticks = 0
+        self._source = None
+        self._fire_at = 0.0
+        self._deadline = 0.0
+        self._first_shown = 0.0
+        self._last_shown = 0.0
+        self._last_report = 0.0
+
+    def start(self):
+        self.cnt = 0
+        self.late = 0
+        self.dropped = 0
+        self.position = self.timeline.active
+        if self._next_index(self.position) is None:
+            # played to the end already, start over from the first frame.
+            self.position = -1
+        self.stats = PlaybackStats()
+        self.timeline.stats = self.stats
+        self._ticks = 0
+        self._deadline = time.monotonic()
+        self._last_report = self._deadline
+        self._schedule()
+
+    def stop(self):
+        if self._source is not None:
+            GLib.source_remove(self._source)
+            self._source = None
+        if self.stats is None:
+            # stopped before it started, while the proxies were prepared.
+            return
+        self.report()
+
+        self.timeline.stats = None
+        if self.cnt:
+            try:
+                Utils.append_log(PLAYBACK_LOG_FILENAME, self.stats.record(self))
+            except (IOError, OSError):
+                pass
+        self.stats = None
+
+    def achieved_fps(self):
+        """Return the ticks of the framerate played per second, holds included."""
+        elapsed = self._last_shown - self._first_shown
+        if self.cnt < 2 or elapsed <= 0:
+            return 0.0
+        return self._ticks / elapsed
+
+    def report(self):
+        text = "%.1f/%d fps" % (self.achieved_fps(), self.timeline.framerate)
+        if self.dropped:
+            text += ", %d dropped" % self.dropped
+        if self.late:
+            text += ", %d late" % self.late
+        self.timeline.fps_label.set_text(text)
+        if self.timeline.show_stats and self.stats is not None:
+            self.timeline.stats_label.set_text(self.stats.text())
+
+    def _schedule(self):
+        now = time.monotonic()
+        delay = max(0.0, self._deadline - now)
+        self._fire_at = now + delay
+        self._source = GLib.timeout_add(int(delay * 1000), self._tick)
+
+    def _next_index(self, index):
+        """Return the playable frame after index, None to stop."""
+        return self.timeline.playable_step(index, 1, wrap=self.timeline.is_replay)
+
+    def _tick(self):
+        self._source = None
+        if not self.timeline.is_playing:
+            return False
+
+        frames = self.timeline.frames
+        framerate = self.timeline.framerate
+        now = time.monotonic()
+        # how long the main loop was busy with other events past our timeout.
+        self.stats.add("events", max(0.0, now - self._fire_at))
+
+        index = self._next_index(self.position)
+        if index is not None:
+            if self.timeline.drop_frames:
+                # drop the frames whose whole hold went by already.
+                while now - self._deadline >= frames[index].duration(framerate):
+                    self._deadline += frames[index].duration(framerate)
+                    self.dropped += 1
+                    index = self._next_index(index)
+                    if index is None:
+                        break
+            elif now - self._deadline >= frames[index].duration(framerate):
+                self.late += 1
+                self._deadline = now
+
+        if index is None:
+            self.timeline.on_toggle_play(self.play_button)
+            return False
+
+        if self.cnt > 0:
+            self._ticks += frames[self.position].ticks(framerate)
+        self.position = index
+        self.timeline.show_frame(index)
+
+        self._last_shown = time.monotonic()
+        self.stats.add("tick", self._last_shown - now)
+        if self.cnt == 0:
+            self._first_shown = self._last_shown
+        self.cnt += 1
+
+        if self._last_shown - self._last_report >= 0.5:
+            self._last_report = self._last_shown
+            self.report()
+
+        self._deadline += frames[index].duration(framerate)
+        self._schedule()
+        return False
+
+
+class AnimFrame():
+    """A frame of the timeline, drawn as a cell of the FrameStrip."""
+
+    def __init__(self, layer, thumbnails, name=None, load=True):
         self.layer = layer
+        self.thumbnails = thumbnails
+        self.name = ""
         self.fixed = False
-
-        self._fix_button_images = []
-        self._fix_button = None
-        self._setup()
+        self.hold, self.hold_ms = 1, None
+        self.highlighted = False
+        # pixbuf, only loaded while the cell is around the visible range.
+        self.thumbnail = None
+        # placeholders are drawn as empty cells until load is called.
+        self.loaded = False
+        if load:
+            self.load(name)
+
+    def load(self, name=None):
+        """Read the name and the hold of the layer."""
+        self.name = self.layer.name if name is None else name
+        self.fixed = self.name[-4:] == PREFIX
+        self.hold, self.hold_ms = Utils.get_hold(self.layer)
+        self.loaded = True
 
     def highlight(self, state):
-        if state:
-            self.set_state_flags(Gtk.StateFlags.SELECTED, True)
-        else:
-            self.set_state_flags(Gtk.StateFlags.NORMAL, True)
+        self.highlighted = state
 
-    def on_toggle_fix(self, widget):
-        self.fixed = widget.get_active()
-        if widget.get_active():
+    def set_fixed(self, state):
+        if state:
             Utils.add_fixed_prefix(self.layer)
-            self._fix_button.set_image(self._fix_button_images[0])
         else:
             Utils.rem_fixed_prefix(self.layer)
-            self._fix_button.set_image(self._fix_button_images[1])
-
-    def _setup(self):
-        self.thumbnail = Gtk.Image()
-        self.label = Gtk.Label(label=self.layer.name)
+        self.fixed = state
+        self.name = self.layer.name
+
+    def set_hold(self, ticks, ms=None):
+        self.hold = max(1, min(int(ticks), HOLD_MAX))
+        self.hold_ms = int(ms) if ms else None
+        Utils.set_hold(self.layer, self.hold, self.hold_ms)
+
+    def duration(self, framerate):
+        """Return how many seconds the frame is shown at framerate."""
+        if self.hold_ms:
+            return self.hold_ms / 1000.0
+        return self.hold / float(framerate)
+
+    def ticks(self, framerate):
+        """Return the hold as a whole number of ticks of framerate."""
+        if self.hold_ms:
+            return max(1, int(round(self.hold_ms * framerate / 1000.0)))
+        return self.hold
+
+    def hold_text(self):
+        if self.hold_ms:
+            return "%dms" % self.hold_ms
+        if self.hold > 1:
+            return "x%d" % self.hold
+        return ""
+
+    def load_thumbnail(self):
+        self.thumbnail = self.thumbnails.get(self.layer)
+
+    def thumbnail_current(self):
+        """Whether the thumbnail is loaded and still shows the layer."""
+        return self.thumbnail is not None and self.thumbnails.current(self.layer)
 
-        icon_size = Gtk.IconSize.MENU
+    def update_layer_info(self):
+        self.thumbnails.invalidate(self.layer)
+        self.load_thumbnail()
+
+    def sync_layer_name(self, name=None):
+        """Follow renames and fixed prefix changes made from GIMP."""
+        self.name = self.layer.name if name is None else name
+        self.fixed = self.name[-4:] == PREFIX
+
+
+class FrameStrip(Gtk.DrawingArea):
+    """
+    Timeline strip drawing the frames as cells with cairo. Only the cells in
+    the visible scroll range are drawn and get their thumbnail loaded, so
+    the cost does not grow with the number of frames.
+    """
+
+    __gsignals__ = {
+        "frame-clicked": (GObject.SignalFlags.RUN_FIRST, None, (int,)),
+        "fix-toggled": (GObject.SignalFlags.RUN_FIRST, None, (int,)),
+        "hold-changed": (GObject.SignalFlags.RUN_FIRST, None, (int, int)),
+        "hold-requested": (GObject.SignalFlags.RUN_FIRST, None, (int,)),
+        "range-clicked": (GObject.SignalFlags.RUN_FIRST, None, (int,)),
+        "move-requested": (GObject.SignalFlags.RUN_FIRST, None, (int,)),
+    }
+
+    def __init__(self, cell_width=CELL_WIDTH, cell_height=CELL_HEIGHT):
+        super().__init__()
+        self.cell_width = cell_width
+        self.cell_height = cell_height
+        self.frames = []
+        # (first, last) indexes of the selected range, None for no range.
+        self.selection = None
+        self.adjustment = Gtk.Adjustment(value=0, lower=0, upper=0,
+                                         step_increment=cell_width,
+                                         page_increment=cell_width, page_size=0)
+
+        self._loaded = set()
+        self._load_source = None
+        self._fix_icons = [self._load_icon("dialog-yes"), self._load_icon("dialog-no")]
+
+        self.set_size_request(-1, cell_height)
+        self.add_events(Gdk.EventMask.BUTTON_PRESS_MASK | Gdk.EventMask.SCROLL_MASK)
+        self.connect("draw", self.on_draw)
+        self.connect("size-allocate", self.on_size_allocate)
+        self.connect("button-press-event", self.on_button_press)
+        self.connect("scroll-event", self.on_scroll)
+        self.adjustment.connect("value-changed", self.on_scrolled)
+
+    def _load_icon(self, name):
+        try:
+            return Gtk.IconTheme.get_default().load_icon(name, CELL_ICON_SIZE, 0)
+        except GLib.Error:
+            return None
 
-        # GTK3 uses icon names instead of stock items
-        self._fix_button = Gtk.ToggleButton()
-        img_no = Gtk.Image.new_from_icon_name("dialog-no", icon_size)
-        self._fix_button.set_image(img_no)
-        self._fix_button.set_tooltip_text("toggle fixed visibility.")
+    def set_frames(self, frames):
+        self.frames = frames
+        self._loaded &= set(frames)
+        if self.selection and self.selection[1] >= len(frames):
+            self.selection = None
+        self._update_adjustment()
+        self.queue_draw()
+
+    def set_selection(self, selection):
+        self.selection = selection
+        self.queue_draw()
+
+    def _update_adjustment(self):
+        width = self.get_allocated_width()
+        upper = len(self.frames) * self.cell_width
+        value = min(self.adjustment.get_value(), max(0, upper - width))
+        self.adjustment.configure(value, 0, upper, self.cell_width, width, width)
+
+    def visible_range(self):
+        """Return the first and the end index of the visible cells."""
+        value = self.adjustment.get_value()
+        first = int(value // self.cell_width)
+        end = int((value + self.get_allocated_width()) // self.cell_width) + 1
+        return max(0, first), min(len(self.frames), end)
+
+    def show_index(self, index):
+        """Scroll the strip just enough to make the cell at index visible."""
+        x = index * self.cell_width
+        value = self.adjustment.get_value()
+        width = self.get_allocated_width()
+        if x < value:
+            self.adjustment.set_value(x)
+        elif x + self.cell_width > value + width:
+            self.adjustment.set_value(x + self.cell_width - width)
+
+    def cell_rect(self, index):
+        rect = Gdk.Rectangle()
+        rect.x = int(index * self.cell_width - self.adjustment.get_value())
+        rect.y = 0
+        rect.width = self.cell_width
+        rect.height = self.cell_height
+        return rect
+
+    def cell_at(self, x, y):
+        """Return the index of the cell at x, y and whether y is on the fix toggle."""
+        index = int((x + self.adjustment.get_value()) // self.cell_width)
+        if index < 0 or index >= len(self.frames):
+            return None, False
+        return index, y >= CELL_FIX_Y
+
+    def _queue_load(self):
+        if self._load_source is None:
+            self._load_source = GLib.idle_add(self._load_visible)
+
+    def _load_visible(self):
+        """Load a batch of the missing thumbnails of the visible cells."""
+        self._load_source = None
+        first, end = self.visible_range()
+
+        loaded = 0
+        for frame in self.frames[first:end]:
+            if not frame.thumbnail_current():
+                frame.load_thumbnail()
+                self._loaded.add(frame)
+                loaded += 1
+                if loaded == THUMB_BATCH:
+                    break
 
-        self.fixed = Utils.is_frame_fixed(self.layer)
+        keep = set(self.frames[max(0, first - THUMB_KEEP_MARGIN):end + THUMB_KEEP_MARGIN])
+        for frame in self._loaded - keep:
+            frame.thumbnail = None
+        self._loaded &= keep
 
-        img_yes = Gtk.Image.new_from_icon_name("dialog-yes", icon_size)
-        img_no2 = Gtk.Image.new_from_icon_name("dialog-no", icon_size)
-        self._fix_button_images = [img_yes, img_no2]
+        # drawing queues the next batch if cells are still missing.
+        self.queue_draw()
+        return False
 
-        self._fix_button.connect('clicked', self.on_toggle_fix)
+    # ---------------------- Callback Functions ---------------------- #
 
-        if self.fixed:
-            self._fix_button.set_image(self._fix_button_images[0])
-            self._fix_button.set_active(True)
+    def on_size_allocate(self, widget, allocation):
+        self._update_adjustment()
+
+    def on_scrolled(self, adjustment):
+        self.queue_draw()
+
+    def on_scroll(self, widget, event):
+        if event.state & Gdk.ModifierType.CONTROL_MASK:
+            index, on_fix = self.cell_at(event.x, event.y)
+            if index is not None:
+                if event.direction in (Gdk.ScrollDirection.UP, Gdk.ScrollDirection.RIGHT):
+                    self.emit("hold-changed", index, 1)
+                elif event.direction in (Gdk.ScrollDirection.DOWN, Gdk.ScrollDirection.LEFT):
+                    self.emit("hold-changed", index, -1)
+            return True
+
+        if event.direction in (Gdk.ScrollDirection.UP, Gdk.ScrollDirection.LEFT):
+            delta = -self.cell_width
+        elif event.direction in (Gdk.ScrollDirection.DOWN, Gdk.ScrollDirection.RIGHT):
+            delta = self.cell_width
         else:
-            self._fix_button.set_image(self._fix_button_images[1])
-            self._fix_button.set_active(False)
-
-        frame = Gtk.Frame()
-        layout = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
-
-        self.add(frame)
-        frame.add(layout)
-
-        layout.pack_start(self.label, False, False, 0)
-        layout.pack_start(self.thumbnail, False, False, 0)
-        layout.pack_start(self._fix_button, False, False, 0)
-        self._get_thumb_image()
-
-    def _get_thumb_image(self):
-        width = 100
-        height = 100
-        image_data = pdb.gimp_drawable_thumbnail(self.layer, width, height)
-
-        w, h, c, data = (image_data[0], image_data[1],
-                         image_data[2], image_data[4])
+            return False
+        self.adjustment.set_value(self.adjustment.get_value() + delta)
+        return True
+
+    def on_button_press(self, widget, event):
+        index, on_fix = self.cell_at(event.x, event.y)
+        if index is None:
+            return False
+        if event.button == 3:
+            self.emit("hold-requested", index)
+        elif event.state & Gdk.ModifierType.SHIFT_MASK:
+            self.emit("range-clicked", index)
+        elif event.state & Gdk.ModifierType.CONTROL_MASK:
+            self.emit("move-requested", index)
+        elif on_fix:
+            self.emit("fix-toggled", index)
+        else:
+            self.emit("frame-clicked", index)
+        return True
+
+    def on_draw(self, widget, cr):
+        style = self.get_style_context()
+        first, end = self.visible_range()
+        offset = self.adjustment.get_value()
+
+        sel_first, sel_last = self.selection or (-1, -1)
+
+        missing = False
+        for i in range(first, end):
+            frame = self.frames[i]
+            self._draw_cell(cr, style, frame, i * self.cell_width - offset,
+                            sel_first <= i <= sel_last)
+            missing = missing or not frame.thumbnail_current()
+
+        if missing:
+            self._queue_load()
+        return False
+
+    def _draw_cell(self, cr, style, frame, x, selected=False):
+        w, h = self.cell_width, self.cell_height
+
+        style.save()
+        style.add_class(Gtk.STYLE_CLASS_VIEW)
+        if frame.highlighted:
+            style.set_state(Gtk.StateFlags.SELECTED)
+        elif selected:
+            style.set_state(Gtk.StateFlags.SELECTED | Gtk.StateFlags.BACKDROP)
+        Gtk.render_background(style, cr, x + 1, 0, w - 2, h)
+        Gtk.render_frame(style, cr, x + 1, 0, w - 2, h)
+
+        layout = self.create_pango_layout(frame.name)
+        layout.set_width((w - 6) * Pango.SCALE)
+        layout.set_ellipsize(Pango.EllipsizeMode.END)
+        Gtk.render_layout(style, cr, x + 3, CELL_LABEL_Y, layout)
+        style.restore()
+
+        if frame.thumbnail is not None:
+            tw, th = frame.thumbnail.get_width(), frame.thumbnail.get_height()
+            Gdk.cairo_set_source_pixbuf(cr, frame.thumbnail,
+                                        x + (w - tw) // 2,
+                                        CELL_THUMB_Y + (THUMB_SIZE - th) // 2)
+            cr.paint()
+        else:
+            Gtk.render_frame(style, cr, x + (w - THUMB_SIZE) // 2, CELL_THUMB_Y,
+                             THUMB_SIZE, THUMB_SIZE)
 
-        # data is already bytes in Python 3
-        image_array = array.array('B', data)
+        hold = frame.hold_text()
+        if hold:
+            layout = self.create_pango_layout(hold)
+            lw = layout.get_pixel_size()[0]
+            Gtk.render_layout(style, cr, x + w - lw - 4, CELL_FIX_Y, layout)
 
-        has_alpha = c > 3
-        colorspace = GdkPixbuf.Colorspace.RGB
-        pixbuf = GdkPixbuf.Pixbuf.new_from_data(
-            image_array.tobytes(), colorspace, has_alpha, 8, w, h, w * c)
-        self.thumbnail.set_from_pixbuf(pixbuf)
+        if not frame.loaded:
+            return
 
-    def update_layer_info(self):
-        self._get_thumb_image()
+        icon = self._fix_icons[0 if frame.fixed else 1]
+        ix = x + (w - CELL_ICON_SIZE) // 2
+        if icon is not None:
+            Gdk.cairo_set_source_pixbuf(cr, icon, ix, CELL_FIX_Y)
+            cr.paint()
+        else:
+            Gtk.render_check(style, cr, ix, CELL_FIX_Y, CELL_ICON_SIZE, CELL_ICON_SIZE)
 
 
 class Timeline(Gtk.Window):
@@ -362,12 +2009,63 @@ class Timeline(Gtk.Window):
         self.play_button_images = []
         self.widgets_to_disable = []
         self.play_bar = None
+        self.fps_label = None
+        self.stats_label = None
+        self.export_job = None
+        self.export_bar = None
+        self.export_progress = None
+        self.export_cancel = None
+        # job filling the placeholder frames while the timeline opens.
+        self.load_job = None
+        # milliseconds from the opening to each startup milestone.
+        self.startup = {}
+        self._opened = time.monotonic()
+        self._opened_at = time.time()
+        self._paint_handler = None
+        # onion skin state to restore once the export is done.
+        self._export_oskin = False
 
         self.frames = []
         self.active = None
         self.before_play = None
 
+        # sorted indexes of the non fixed frames and their position in it.
+        self.playable = []
+        self._playable_rank = {}
+
+        # shadow copy of the layer properties the timeline has set, so
+        # unchanged values are not written again through the PDB.
+        self._layer_state = {}
+        self._shown = {}
+        self._highlighted = None
+        self._active_layer_id = None
+
+        self._transaction_depth = 0
+        self.flush_count = 0
+
+        # signature of the image at the last rescan, see _image_signature.
+        self._signature = None
+        self._focus_source = None
+        # layer ID to timeline index, the first frame being the bottom layer.
+        self._frame_index = {}
+
+        # scrubbing: only the latest frame asked is shown, once per redraw.
+        self.scrubber = None
+        self._scrub_target = None
+        self._scrub_update = False
+        self._scrub_pending = False
+        self._scrub_syncing = False
+
         self.framerate = 30
+        self.drop_frames = True
+        self.prerender = False
+        self.show_stats = False
+        self.sheet_columns = 0
+        self.sheet_padding = 0
+        self.dedupe_frames = False
+        self.dedupe_tolerance = 0
+        self.atlas_max_size = ATLAS_MAX_SIZE_DEFAULT
+        self.atlas_pot = True
         self.new_layer_type = TRANSPARENT_FILL
 
         self.oskin = False
@@ -376,8 +2074,17 @@ class Timeline(Gtk.Window):
         self.oskin_forward = False
         self.oskin_max_opacity = OSKIN_MAX_OPACITY
         self.oskin_onplay = True
+        self.oskin_overlay = False
+        self.oskin_falloff = OSKIN_FALLOFF_DEFAULT
 
         self.player = None
+        # PlaybackStats collecting timings while playing.
+        self.stats = None
+        self.thumbnails = ThumbnailCache()
+        self.thumb_store = ThumbnailStore(image)
+        self.playback_cache = PlaybackCache(self)
+        self.onion = OnionSkin(self)
+        self.preview = None
 
         self.win_pos = (20, 20)
         self.win_size = (200, 200)
@@ -390,12 +2097,53 @@ class Timeline(Gtk.Window):
         else:
             self.image.undo_freeze()
 
+    @contextmanager
+    def transaction(self):
+        """
+        Run the layer changes of one user action under a single undo freeze
+        and a single display flush. Nested transactions join the outer one.
+        """
+        self._transaction_depth += 1
+        if self._transaction_depth == 1:
+            self.undo(False)
+        try:
+            yield
+        finally:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self.undo(True)
+                start = time.monotonic()
+                gimp.displays_flush()
+                if self.stats is not None:
+                    self.stats.add("flush", time.monotonic() - start)
+                self.flush_count += 1
+
     def destroy(self, widget):
         if self.is_playing:
             self.is_playing = False
             gimp.message("Please do not close the image with FAnim playing the animation.")
-        if widget is not False:
-            pdb.script_fu_reverse_layers(self.image, None)
+        if self._focus_source is not None:
+            GLib.source_remove(self._focus_source)
+            self._focus_source = None
+        if self.export_job is not None:
+            job, self.export_job = self.export_job, None
+            job.cancel()
+        loading = self.load_job is not None
+        if loading:
+            # placeholders do not know the fixed frames, leave the layers be.
+            job, self.load_job = self.load_job, None
+            job.cancel()
+        if widget is not False and not loading and self.image.layers:
+            # follow what was changed since the last focus check, the
+            # thumbnails included, before they are saved.
+            self._check_image()
+            if not pdb.gimp_image_is_dirty(self.image):
+                try:
+                    self.thumb_store.save(self.thumbnails.persistent(
+                        [f.layer for f in self.frames]))
+                except (IOError, OSError):
+                    pass
+
             self.on_goto(None, START)
 
         Utils.save_conffile(CONF_FILENAME, self.get_settings())
@@ -422,6 +2170,7 @@ class Timeline(Gtk.Window):
         self.connect("destroy", self.destroy)
         self.connect("focus_in_event", self.on_window_focus)
         self.connect("configure_event", self.on_window_resize)
+        self.connect("key-press-event", self.on_key_press)
 
         self.set_default_size(self.win_size[0], self.win_size[1])
         self.set_keep_above(True)
@@ -431,7 +2180,6 @@ class Timeline(Gtk.Window):
         try:
             gtkrc_path = self._get_theme_gtkrc(gimp.personal_rc_file('themerc'))
             if os.name != 'nt' and gtkrc_path:
-                from gi.repository import Gdk
                 css_provider = Gtk.CssProvider()
                 # GTK3 can't parse GTK2 rc files directly; silently skip on error
                 try:
@@ -454,47 +2202,284 @@ class Timeline(Gtk.Window):
         cbar.pack_start(self._setup_config(), False, False, 10)
         cbar.pack_start(self._setup_generalbar(), False, False, 10)
 
-        self.frame_bar = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
-        scroll_window = Gtk.ScrolledWindow()
-        scroll_window.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC)
-
-        viewport = Gtk.Viewport()
-        viewport.add(self.frame_bar)
-        scroll_window.add(viewport)
-        scroll_window.set_size_request(-1, 140)
+        self.frame_bar = FrameStrip()
+        self.frame_bar.set_tooltip_text("click to go to a frame, click the icon to toggle fixed visibility, "
+                                        "ctrl+scroll or right click to change how long it is held, "
+                                        "shift+click to select a range and ctrl+click to move it there.")
+        self.frame_bar.connect("frame-clicked", self.on_click_goto)
+        self.frame_bar.connect("fix-toggled", self.on_toggle_fix)
+        self.frame_bar.connect("hold-changed", self.on_hold_changed)
+        self.frame_bar.connect("hold-requested", self.on_hold_edit)
+        self.frame_bar.connect("range-clicked", self.on_select_range)
+        self.frame_bar.connect("move-requested", self.on_move_to)
+        scrollbar = Gtk.Scrollbar(orientation=Gtk.Orientation.HORIZONTAL,
+                                  adjustment=self.frame_bar.adjustment)
+
+        self.scrubber = Gtk.Scale(orientation=Gtk.Orientation.HORIZONTAL,
+                                  adjustment=Gtk.Adjustment(value=0, lower=0, upper=0,
+                                                            step_increment=1, page_increment=10))
+        self.scrubber.set_draw_value(False)
+        self.scrubber.set_round_digits(0)
+        self.scrubber.set_tooltip_text("drag to scrub through the frames, the arrow keys, "
+                                       "home and end also move between frames.")
+        self.scrubber.connect("value-changed", self.on_scrub)
+
+        strip_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        strip_box.pack_start(self.scrubber, False, False, 0)
+        strip_box.pack_start(self.frame_bar, True, True, 0)
+        strip_box.pack_start(scrollbar, False, False, 0)
+
+        self.preview = PreviewArea()
+        self.preview.set_no_show_all(True)
+        self.preview.set_visible(self.prerender or self._overlay_mode())
+
+        self.stats_label = Gtk.Label(label="")
+        self.stats_label.set_halign(Gtk.Align.START)
+        self.stats_label.set_no_show_all(True)
+        self.stats_label.set_visible(self.show_stats)
+
+        self.export_progress = Gtk.ProgressBar(show_text=True)
+        self.export_cancel = Utils.button_stock("process-stop", Gtk.IconSize.BUTTON)
+        self.export_cancel.set_tooltip_text("Cancel the export")
+        self.export_cancel.connect("clicked", self.on_cancel_export)
+        self.export_bar = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
+        self.export_bar.pack_start(self.export_progress, True, True, 4)
+        self.export_bar.pack_start(self.export_cancel, False, False, 0)
+        self.export_bar.set_no_show_all(True)
+        self.export_progress.show()
+        self.export_cancel.show()
 
         base.pack_start(cbar, False, False, 0)
-        base.pack_start(scroll_window, True, True, 0)
+        base.pack_start(self.stats_label, False, False, 2)
+        base.pack_start(self.export_bar, False, False, 2)
+        base.pack_start(self.preview, True, True, 0)
+        base.pack_start(strip_box, True, True, 0)
         self.add(base)
 
-        pdb.script_fu_reverse_layers(self.image, None)
-        self._scan_image_layers()
-        self.active = 0
-        self.on_goto(None, GIMP_ACTIVE)
-
+        # the window opens empty, the frames are filled in from the main loop.
+        self._paint_handler = self.connect_after("draw", self.on_first_paint)
         self.show_all()
+        self._mark("window")
+
+        self._check_stack_order()
+        self.load_job = ExportJob(self._load_frames(), 1, self.export_progress,
+                                  self.on_frames_loaded, "Loading the frames")
+        self._toggle_enable_buttons(LOADING)
+        self.export_cancel.hide()
+        self.export_bar.show()
+        self.load_job.start()
+
+    def _mark(self, milestone):
+        """Note the time of a startup milestone, only the first one counts."""
+        if milestone not in self.startup:
+            self.startup[milestone] = round((time.monotonic() - self._opened) * 1000.0, 1)
+
+    def _load_frames(self):
+        """
+        Fill the timeline once the window is shown. Every layer gets a
+        placeholder frame at once, then the frames are read in batches, the
+        visible cells first and the others outward from the active layer.
+        The image is reconciled with the names read at the end.
+
+        The layer stack is checked before every batch. The job returns False
+        as soon as it was changed from GIMP, for a full rescan instead.
+        """
+        self.thumbnails.persist = self.thumb_store.path is not None
+        self.thumbnails.preload(self.thumb_store.load())
 
-    def _scan_image_layers(self):
-        self.undo(False)
         layers = self.image.layers
+        ids = [l.ID for l in layers]
+        active = self.image.active_layer
+        self.frames = [AnimFrame(l, self.thumbnails, load=False) for l in reversed(layers)]
+        self._frame_index = {f.layer.ID: i for i, f in enumerate(self.frames)}
+        self.frame_bar.set_frames(self.frames)
+        self._index_playable()
+        self.active = self._frame_index.get(active.ID, 0) if active else 0
+        self.frame_bar.show_index(self.active)
+        self._mark("placeholders")
+        yield len(self.frames) + 1
+
+        # names in timeline order, None until the layer is read.
+        names = [None] * len(self.frames)
+        order = iter(sorted(range(len(names)), key=lambda i: abs(i - self.active)))
+        while True:
+            if [l.ID for l in self.image.layers] != ids:
+                return False
+
+            first, end = self.frame_bar.visible_range()
+            batch = [i for i in range(first, end) if names[i] is None][:LOAD_BATCH]
+            if not batch:
+                self._mark("visible_ready")
+                batch = [i for i in itertools.islice(order, LOAD_BATCH) if names[i] is None]
+                if not batch and all(n is not None for n in names):
+                    break
 
-        if self.frames:
-            for frame in self.frames:
-                self.frame_bar.remove(frame)
-                frame.destroy()
+            with self.transaction():
+                for i in batch:
+                    frame = self.frames[i]
+                    names[i] = frame.layer.name
+                    frame.layer.mode = NORMAL_MODE
+                    frame.layer.opacity = 100.0
+                    frame.load(names[i])
+            self.frame_bar.queue_draw()
+            for i in batch:
+                yield
+
+        with self.transaction():
+            self._reconcile_frames(layers, names[::-1])
+            if self.frames:
+                self.on_goto(None, GIMP_ACTIVE)
+        self._mark("frames_ready")
+        yield
+        return True
+
+    def on_first_paint(self, widget, cr):
+        self.disconnect(self._paint_handler)
+        self._paint_handler = None
+        self._mark("first_paint")
+        return False
+
+    def on_frames_loaded(self, job, completed):
+        if job is not self.load_job:
+            # the timeline was closed while loading.
+            return
+        self.load_job = None
+        self.export_bar.hide()
+        self.export_cancel.show()
+        self._toggle_enable_buttons(LOADING)
+
+        if not completed or not job.result:
+            # read the image again the usual way, like after a change in GIMP.
             self.frames = []
+            self._frame_index = {}
+            self.active = self.active or 0
+            self._signature = None
+            self._check_image()
+            return
+
+        record = {
+            "started": self._opened_at,
+            "image": self.image.name,
+            "frames": len(self.frames),
+            "milestones_ms": self.startup,
+        }
+        try:
+            Utils.append_log(STARTUP_LOG_FILENAME, record)
+        except (IOError, OSError):
+            pass
+
+    def _scan_image_layers(self, layers=None, names=None):
+        """
+        Reconcile the frames with the image layers, creating, dropping or
+        reordering only the frames that actually changed. The layers and
+        their names can be given when they were just read.
+        """
+        with self.transaction():
+            self._reconcile_frames(layers, names)
+
+    def _reconcile_frames(self, layers=None, names=None):
+        if layers is None:
+            layers = self.image.layers
+        if names is None:
+            names = [l.name for l in layers]
+
+        current = {f.layer.ID: f for f in self.frames}
+        frames = []
+
+        for layer, name in zip(reversed(layers), reversed(names)):
+            f = current.pop(layer.ID, None)
+            if f is None:
+                layer.mode = NORMAL_MODE
+                layer.opacity = 100.0
+                f = AnimFrame(layer, self.thumbnails, name)
+            else:
+                f.sync_layer_name(name)
+            frames.append(f)
+
+        for f in current.values():
+            self._forget_frame(f)
+
+        self.frames = frames
+        self._frame_index = {f.layer.ID: i for i, f in enumerate(frames)}
+        self.frame_bar.set_frames(frames)
+        self._index_playable()
+
+        self._signature = self._image_signature(layers, names)
+
+    def stack_position(self, index):
+        """Position in the layer stack of the frame at timeline index."""
+        return len(self.frames) - 1 - index
+
+    def _check_stack_order(self):
+        """
+        Offer to reverse the layer stack of an image that was never opened
+        by this version, as older ones saved the first frame at the top.
+        Both answers are remembered in the image, the reversal is a single
+        undo step.
+        """
+        layers = self.image.layers
+        if len(layers) < 2 or self.image.parasite_find(ORDER_PARASITE) is not None:
+            return
 
-        for layer in reversed(layers):
-            layer.mode = NORMAL_MODE
-            layer.opacity = 100.0
+        dialog = Gtk.MessageDialog(parent=self, modal=True,
+                                   message_type=Gtk.MessageType.QUESTION,
+                                   text="Reverse the layer stack of this image?")
+        dialog.format_secondary_text(
+            "FAnim plays the bottom layer first. Images saved by older versions of "
+            "FAnim have their first frame at the top and play backwards until they "
+            "are reversed once. The reversal can be undone from GIMP.")
+        dialog.add_buttons("Keep the order", Gtk.ResponseType.NO,
+                           "Reverse the layers", Gtk.ResponseType.YES)
+        dialog.set_default_response(Gtk.ResponseType.YES)
+        reverse = dialog.run() == Gtk.ResponseType.YES
+        dialog.destroy()
+
+        self.image.undo_group_start()
+        try:
+            if reverse:
+                for position, layer in enumerate(reversed(layers)):
+                    pdb.gimp_image_reorder_item(self.image, layer, None, position)
+            self.image.attach_new_parasite(ORDER_PARASITE, PARASITE_PERSISTENT, ORDER_BOTTOM_UP)
+        finally:
+            self.image.undo_group_end()
+        gimp.displays_flush()
 
-            f = AnimFrame(layer)
-            f.connect("button_press_event", self.on_click_goto)
-            self.frame_bar.pack_start(f, False, True, 2)
-            self.frames.append(f)
-            f.show_all()
+    @staticmethod
+    def _image_signature(layers, names):
+        """
+        Cheap summary of the layer stack telling whether a rescan is needed:
+        the layers, their order and their names. Visibility changed from
+        GIMP is followed by _sync_layer_state and pixel edits by the
+        thumbnail cache, neither needs a rescan.
+        """
+        return tuple(l.ID for l in layers), tuple(names)
+
+    def _index_playable(self):
+        self.playable = [i for i, f in enumerate(self.frames) if not f.fixed]
+        self._playable_rank = {index: pos for pos, index in enumerate(self.playable)}
+
+    def playable_step(self, index, step, wrap=True):
+        """
+        Return the index of the playable frame step positions away from the
+        frame at index, skipping fixed frames. Without wrap, None is returned
+        when that goes past either end, and always when nothing is playable.
+        """
+        if not self.playable:
+            return None
+
+        pos = self._playable_rank.get(index)
+        if pos is not None:
+            pos += step
+        elif step > 0:
+            pos = bisect.bisect_right(self.playable, index) + step - 1
+        else:
+            pos = bisect.bisect_left(self.playable, index) + step
 
-        self.undo(True)
+        if wrap:
+            pos %= len(self.playable)
+        elif pos < 0 or pos >= len(self.playable):
+            return None
+        return self.playable[pos]
 
     def _setup_playbackbar(self):
         playback_bar = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
@@ -518,8 +2503,8 @@ class Timeline(Gtk.Window):
 
         b_play.connect('clicked', self.on_toggle_play)
         b_repeat.connect('toggled', self.on_replay)
-        b_next.connect('clicked', self.on_goto, NEXT, True)
-        b_prev.connect('clicked', self.on_goto, PREV, True)
+        b_next.connect('clicked', self.on_step, 1)
+        b_prev.connect('clicked', self.on_step, -1)
         b_toend.connect('clicked', self.on_goto, END, True)
         b_tostart.connect('clicked', self.on_goto, START, True)
 
@@ -535,8 +2520,12 @@ class Timeline(Gtk.Window):
         b_tostart.set_tooltip_text("To the start frame")
         b_toend.set_tooltip_text("To the end frame")
 
+        self.fps_label = Gtk.Label(label="")
+        self.fps_label.set_tooltip_text("Achieved/target framerate of the last playback")
+
         for x in [b_tostart, b_prev, b_play, b_next, b_toend, b_repeat]:
             playback_bar.pack_start(x, False, False, 0)
+        playback_bar.pack_start(self.fps_label, False, False, 6)
         return playback_bar
 
     def _setup_editbar(self):
@@ -559,11 +2548,11 @@ class Timeline(Gtk.Window):
         b_back.connect("clicked", self.on_move, PREV)
         b_forward.connect("clicked", self.on_move, NEXT)
 
-        b_rem.set_tooltip_text("Remove a frame/layer")
-        b_add.set_tooltip_text("Add a frame/layer")
-        b_copy.set_tooltip_text("Duplicate the atual selected frame")
-        b_back.set_tooltip_text("Move the atual selected frame backward")
-        b_forward.set_tooltip_text("Move the atual selected frame forward")
+        b_rem.set_tooltip_text("Remove the selected frames/layers")
+        b_add.set_tooltip_text("Add a frame/layer, one per selected frame")
+        b_copy.set_tooltip_text("Duplicate the selected frames")
+        b_back.set_tooltip_text("Move the selected frames backward")
+        b_forward.set_tooltip_text("Move the selected frames forward")
 
         for x in w:
             edit_bar.pack_start(x, False, False, 0)
@@ -575,20 +2564,33 @@ class Timeline(Gtk.Window):
 
         b_to_gif = Utils.button_stock("image-x-generic", stock_size)
         b_to_sprite = Utils.button_stock("image-x-generic", stock_size)
+        b_to_atlas = Utils.button_stock("package-x-generic", stock_size)
+        b_to_file = Utils.button_stock("document-save-as", stock_size)
         b_conf = Utils.button_stock("preferences-system", stock_size)
+        b_stats = Utils.toggle_button_stock("utilities-system-monitor", stock_size)
+        b_stats.set_active(self.show_stats)
 
         b_conf.connect("clicked", self.on_config)
+        b_stats.connect("toggled", self.on_toggle_stats)
         b_to_gif.connect('clicked', self.create_formated_version, 'gif')
         b_to_sprite.connect('clicked', self.create_formated_version, 'spritesheet')
+        b_to_atlas.connect('clicked', self.create_formated_version, 'atlas')
+        b_to_file.connect('clicked', self.create_formated_version, 'animation')
 
         b_conf.set_tooltip_text("open configuration dialog")
         b_to_gif.set_tooltip_text("Create a formated Image to export as gif animation")
         b_to_sprite.set_tooltip_text("Create a formated Image to export as spritesheet")
+        b_to_atlas.set_tooltip_text("Save a trimmed texture atlas with JSON frame data (needs numpy)")
+        b_to_file.set_tooltip_text("Save the animation straight to an animated PNG, gif (needs Pillow) "
+                                   "or WebP (needs img2webp) file (needs numpy)")
+        b_stats.set_tooltip_text("show playback timings, sessions are logged to fanim/" + PLAYBACK_LOG_FILENAME)
 
         w = [b_conf, b_to_gif, b_to_sprite]
+        if np is not None:
+            w += [b_to_atlas, b_to_file]
         for x in w:
             self.widgets_to_disable.append(x)
-        for x in w:
+        for x in w + [b_stats]:
             config_bar.pack_start(x, False, False, 0)
         return config_bar
 
@@ -630,10 +2632,21 @@ class Timeline(Gtk.Window):
     def get_settings(self):
         s = {}
         s[FRAMERATE] = self.framerate
+        s[DROP_FRAMES] = self.drop_frames
+        s[PRERENDER] = self.prerender
+        s[SHOW_STATS] = self.show_stats
+        s[SHEET_COLUMNS] = self.sheet_columns
+        s[SHEET_PADDING] = self.sheet_padding
+        s[DEDUPE_FRAMES] = self.dedupe_frames
+        s[DEDUPE_TOLERANCE] = self.dedupe_tolerance
+        s[ATLAS_MAX_SIZE] = self.atlas_max_size
+        s[ATLAS_POT] = self.atlas_pot
         s[OSKIN_DEPTH] = self.oskin_depth
         s[OSKIN_FORWARD] = self.oskin_forward
         s[OSKIN_BACKWARD] = self.oskin_backward
         s[OSKIN_ONPLAY] = self.oskin_onplay
+        s[OSKIN_OVERLAY] = self.oskin_overlay
+        s[OSKIN_FALLOFF] = self.oskin_falloff
         s[WIN_POSX] = self.win_pos[0]
         s[WIN_POSY] = self.win_pos[1]
         alloc = self.get_allocation()
@@ -645,35 +2658,110 @@ class Timeline(Gtk.Window):
         if conf is None:
             return
         self.framerate = int(conf[FRAMERATE])
+        self.drop_frames = conf.get(DROP_FRAMES, True)
+        self.prerender = conf.get(PRERENDER, False)
+        self.show_stats = conf.get(SHOW_STATS, False)
+        self.sheet_columns = int(conf.get(SHEET_COLUMNS, 0))
+        self.sheet_padding = int(conf.get(SHEET_PADDING, 0))
+        self.dedupe_frames = conf.get(DEDUPE_FRAMES, False)
+        self.dedupe_tolerance = int(conf.get(DEDUPE_TOLERANCE, 0))
+        self.atlas_max_size = int(conf.get(ATLAS_MAX_SIZE, ATLAS_MAX_SIZE_DEFAULT))
+        self.atlas_pot = conf.get(ATLAS_POT, True)
         self.oskin_depth = int(conf[OSKIN_DEPTH])
         self.oskin_forward = conf[OSKIN_FORWARD]
         self.oskin_backward = conf[OSKIN_BACKWARD]
         self.oskin_onplay = conf[OSKIN_ONPLAY]
+        self.oskin_overlay = conf.get(OSKIN_OVERLAY, False)
+        self.oskin_falloff = float(conf.get(OSKIN_FALLOFF, OSKIN_FALLOFF_DEFAULT))
         self.win_size = (conf[WIN_WIDTH], conf[WIN_HEIGHT])
         self.win_pos = (conf[WIN_POSX], conf[WIN_POSY])
 
     def _toggle_enable_buttons(self, state):
-        if state == PLAYING:
+        if state in (PLAYING, EXPORTING, LOADING):
+            # nothing may change the frames while a job reads them.
+            busy = self.export_job is not None or self.load_job is not None
             for w in self.widgets_to_disable:
-                w.set_sensitive(not self.is_playing)
+                w.set_sensitive(not self.is_playing and not busy)
+            self.scrubber.set_sensitive(not self.is_playing and not busy)
+            if state != PLAYING:
+                self.frame_bar.set_sensitive(not busy)
+                self.play_bar.set_sensitive(not busy and bool(self.frames))
         elif state == NO_FRAMES:
             self.play_bar.set_sensitive(not self.play_bar.get_sensitive())
 
     # ---------------------- Callback Functions ---------------------- #
 
     def on_window_focus(self, widget, other):
-        time.sleep(0.1)
+        # focus often comes in bursts, only check the image once it settles.
+        if self._focus_source is not None:
+            GLib.source_remove(self._focus_source)
+        self._focus_source = GLib.timeout_add(FOCUS_DEBOUNCE, self._on_focus_settled)
+
+    def _on_focus_settled(self):
+        self._focus_source = None
+        self._check_image()
+        return False
+
+    def _check_image(self):
+        """
+        Follow what was changed on the image from GIMP, rescanning only when
+        its signature differs from the one of the last rescan.
+        """
+        if self.load_job is not None or self.export_job is not None:
+            return
         if self.image not in gimp.image_list():
             self.destroy(False)
-        else:
-            if not self.image.layers:
-                self.destroy(False)
-            else:
-                if self.active >= len(self.image.layers):
-                    self.active = len(self.image.layers) - 1
-                self._scan_image_layers()
+            return
+
+        layers = self.image.layers
+        if not layers:
+            self.destroy(False)
+            return
+
+        names = [l.name for l in layers]
+        if self.is_playing:
+            if self._image_signature(layers, names) == self._signature:
+                # the rest is caught up with once the playback stops.
+                return
+            # frames were added or removed: stop playing them before the
+            # rescan, the frame shown before playing may be gone.
+            self._stop_playing()
+            self.before_play = None
+
+        with self.transaction():
+            toggled = self._sync_layer_state(layers)
+            # None when a channel or a path is selected in GIMP.
+            active = self.image.active_layer
+
+            if self._image_signature(layers, names) != self._signature:
+                if self.active >= len(layers):
+                    self.active = max(0, len(layers) - 1)
+                self._active_layer_id = None
+                self._scan_image_layers(layers, names)
                 self.on_goto(None, GIMP_ACTIVE)
 
+            elif active is not None and active.ID != self._active_layer_id:
+                self.on_goto(None, GIMP_ACTIVE)
+
+            elif toggled:
+                self.on_goto(None, NOWHERE)
+
+            # GIMP has no change counter to tell which layers were edited, or
+            # even whether any was: its dirty flag is cleared by saving.
+            self.thumbnails.expire()
+            self.frame_bar.queue_draw()
+
+    def _sync_layer_state(self, layers):
+        """
+        Forget the shadow state of the layers whose visibility was changed
+        from GIMP, so the timeline sets it again. Return whether any was.
+        """
+        toggled = [l.ID for l in layers
+                   if l.ID in self._layer_state and l.visible != self._layer_state[l.ID][0]]
+        for key in toggled:
+            del self._layer_state[key]
+        return bool(toggled)
+
     def on_about(self, widget):
         about = Gtk.AboutDialog()
         about.set_authors(AUTHORS)
@@ -684,56 +2772,572 @@ class Timeline(Gtk.Window):
         about.destroy()
 
     def create_formated_version(self, widget, format='gif'):
-        oskin_disabled = False
-        if self.oskin:
-            self.on_onionskin(None)
-            oskin_disabled = True
-
-        # In Python 3, filter() returns an iterator → convert to list
-        normal_frames = list(filter(lambda x: x.fixed == False, self.frames))
-        fixed_frames = list(filter(lambda x: x.fixed == True, self.frames))
+        """Start building the export image in the background."""
+        if self.export_job is not None or not self.frames:
+            return
 
-        new_image = gimp.Image(self.image.width, self.image.height, self.image.base_type)
+        stacks = self._frame_stacks()
+        fixed = len(self.frames) - len(stacks)
+        gif_units = 2 * fixed + len(stacks)
 
-        normal_frames.reverse()
+        if format == 'atlas':
+            path = self._choose_atlas_path()
+            if path is None:
+                return
+            steps, total = self._create_atlas(path), len(stacks) + 2
+        elif format == 'animation':
+            chosen = self._choose_animation_path()
+            if chosen is None:
+                return
+            steps, total = self._write_animation(*chosen), len(stacks) + 1
+        elif format == 'spritesheet' and np is not None:
+            steps, total = self._create_spritesheet(self._choose_sheet_index_path()), len(stacks) + 1
+        elif format == 'spritesheet':
+            steps = self._create_spritesheet_pdb(self._choose_sheet_index_path())
+            total = gif_units + len(stacks)
+        else:
+            steps, total = self._create_gif(), gif_units
 
-        for fl in normal_frames:
-            group = gimp.GroupLayer(new_image, fl.layer.name)
+        self._export_oskin = self.oskin
+        if self.oskin:
+            self.on_onionskin(None)
 
-            lcopy = pdb.gimp_layer_new_from_drawable(fl.layer, new_image)
-            lcopy.visible = True
+        self.export_job = ExportJob(steps, total, self.export_progress, self.on_export_done)
+        self._toggle_enable_buttons(EXPORTING)
+        self.export_bar.show()
+        self.export_job.start()
 
-            new_image.add_layer(group, len(new_image.layers))
-            new_image.insert_layer(lcopy, group, 0)
+    def on_export_done(self, job, completed):
+        if job is not self.export_job:
+            # the timeline was closed while exporting.
+            return
+        self.export_job = None
+        self.export_bar.hide()
+        self._toggle_enable_buttons(EXPORTING)
+        if self._export_oskin and not self.oskin:
+            self.on_onionskin(None)
+        # catch up with what was changed from GIMP meanwhile.
+        self._check_image()
 
-            up_fixed = list(filter(
-                lambda x: self.frames.index(x) > self.frames.index(fl),
-                fixed_frames))
-            bottom_fixed = list(filter(
-                lambda x: self.frames.index(x) < self.frames.index(fl),
-                fixed_frames))
+    def on_proxies_ready(self, job, completed):
+        if job is not self.export_job:
+            return
+        self.export_job = None
+        self.export_bar.hide()
+        self._toggle_enable_buttons(PLAYING)
+        if completed:
+            self.player.start()
+        else:
+            self.on_toggle_play(self.player.play_button)
+
+    def on_cancel_export(self, widget):
+        if self.export_job is not None:
+            self.export_job.cancel()
+
+    def _create_gif(self):
+        new_image = yield from self._create_gif_image()
+        gimp.Display(new_image)
+
+    def _frame_stacks(self):
+        """
+        Return (frame, stack) for every non fixed frame, stack being the
+        frames to composite from the bottom to the top, fixed ones included.
+        """
+        fixed = [i for i, f in enumerate(self.frames) if f.fixed]
+        stacks = []
+        for i, f in enumerate(self.frames):
+            if f.fixed:
+                continue
+            stack = ([self.frames[j] for j in fixed if j < i] + [f] +
+                     [self.frames[j] for j in fixed if j > i])
+            stacks.append((f, stack))
+        return stacks
+
+    def _create_gif_image(self, merge=None):
+        """
+        Export steps returning a new image with a layer group per non fixed
+        frame, each holding the frame between one flattened copy of the fixed
+        frames below it and one of the fixed frames above it. With merge,
+        frames showing the same pixels as the previous one only lengthen its
+        group's delay.
+        """
+        if merge is None:
+            merge = self.dedupe_frames
+        tolerance = self.dedupe_tolerance if np is not None else 0
+        frames = list(self.frames)
+        new_image = gimp.Image(self.image.width, self.image.height, self.image.base_type)
+        work = gimp.Image(self.image.width, self.image.height, self.image.base_type)
+        work.disable_undo()
 
-            b = 0
-            for ff in fixed_frames:
-                copy = pdb.gimp_layer_new_from_drawable(ff.layer, new_image)
-                if ff in bottom_fixed:
-                    new_image.insert_layer(copy, group, len(group.layers) - b)
-                    b += 1
-                elif ff in up_fixed:
-                    new_image.insert_layer(copy, group, 0)
+        try:
+            below, above = yield from self._fixed_composites(work, frames)
+
+            # k counts the fixed frames met so far, the frames between two
+            # fixed frames share the same composites.
+            k = 0
+            group, group_k = None, -1
+            group_name, group_delay, kept = None, 0, None
+            for fl in frames:
+                if fl.fixed:
+                    k += 1
+                    continue
+
+                # GIMP's gif exporter reads the frame delay from the layer name.
+                delay = int(round(fl.duration(self.framerate) * 1000))
+
+                key = self._pixels_key(fl.layer) if merge else None
+                if merge and group_k == k and self._same_pixels(kept, fl.layer, key, tolerance):
+                    group_delay += delay
+                    group.name = "%s (%dms)" % (group_name, group_delay)
+                    yield
+                    continue
+
+                group_name, group_delay, group_k = fl.layer.name, delay, k
+                kept = [fl.layer, key, None]
+                group = gimp.GroupLayer(new_image, "%s (%dms)" % (group_name, delay))
+                new_image.add_layer(group, 0)
+
+                for layer in (above[k], fl.layer, below[k]):
+                    if layer is None:
+                        continue
+                    copy = pdb.gimp_layer_new_from_drawable(layer, new_image)
+                    copy.visible = True
+                    new_image.insert_layer(copy, group, len(group.layers))
+                yield
+        except BaseException:
+            pdb.gimp_image_delete(new_image)
+            raise
+        finally:
+            pdb.gimp_image_delete(work)
+
+        return new_image
+
+    def _pixels_key(self, layer):
+        """Return the size, the offsets and the thumbnail bytes of layer."""
+        return ((layer.width, layer.height) + tuple(layer.offsets),
+                self.thumbnails.get(layer).get_pixels())
 
-        if format == 'gif':
-            gimp.Display(new_image)
+    @staticmethod
+    def _same_pixels(kept, layer, key, tolerance):
+        """
+        Whether layer shows the same pixels as the frame a gif group started
+        with, kept being its [layer, _pixels_key, pixels read on demand].
+        Thumbnails are averages of the pixels, so the ones apart by more
+        than the tolerance rule a frame out without reading it.
+        """
+        if key[0] != kept[1][0]:
+            return False
+        if not tolerance:
+            if key[1] != kept[1][1]:
+                return False
+            if kept[2] is None:
+                kept[2] = Utils.layer_bytes(kept[0])
+            return Utils.layer_bytes(layer) == kept[2]
+
+        thumbs = [np.frombuffer(t, dtype=np.uint8) for t in (key[1], kept[1][1])]
+        # one more for the rounding of the thumbnails.
+        if not Pixels.similar(thumbs[0], thumbs[1], tolerance + 1):
+            return False
+        if kept[2] is None:
+            kept[2] = Pixels.read(kept[0])
+        return Pixels.similar(kept[2], Pixels.read(layer), tolerance)
+
+    def _fixed_composites(self, work, frames):
+        """
+        Flatten in work the fixed frames below and above every position.
+        below[k] holds the first k fixed frames merged and above[k] the rest,
+        None standing for an empty stack.
+        """
+        fixed = [f.layer for f in frames if f.fixed]
+
+        below = {0: None}
+        for k in range(1, len(fixed) + 1):
+            below[k] = self._merge_copy(work, below[k - 1], fixed[k - 1], True)
+            yield
+
+        above = {len(fixed): None}
+        for k in range(len(fixed) - 1, -1, -1):
+            above[k] = self._merge_copy(work, above[k + 1], fixed[k], False)
+            yield
+
+        return below, above
+
+    def _merge_copy(self, work, base, layer, on_top):
+        """Return a new layer of work with layer merged over or under base."""
+        copy = pdb.gimp_layer_new_from_drawable(layer, work)
+        copy.visible = True
+        if base is None:
+            work.add_layer(copy, 0)
+            return copy
+
+        dup = pdb.gimp_layer_new_from_drawable(base, work)
+        dup.visible = True
+        work.add_layer(dup, 0)
+        if on_top:
+            work.add_layer(copy, 0)
+            upper = copy
+        else:
+            work.add_layer(copy, 1)
+            upper = dup
+        return work.merge_down(upper, CLIP_TO_IMAGE)
+
+    def _frame_cells(self, stacks):
+        """
+        Yield (frame, cell) with the stack of every frame composited into a
+        cell of the canvas size, one at a time, reading each layer's pixels
+        only once. Only the pixels of the fixed frames are kept around.
+        """
+        cw, ch = self.image.width, self.image.height
+        pixels = {}
+        for frame, stack in stacks:
+            cell = np.zeros((ch, cw, 4), dtype=np.uint8)
+            for f in stack:
+                if f.layer.ID not in pixels:
+                    pixels[f.layer.ID] = (Pixels.read(f.layer), f.layer.offsets)
+                data, (ox, oy) = pixels[f.layer.ID]
+                Pixels.over(cell, data, ox, oy)
+
+            # the frame's own layer is not used by any other cell.
+            del pixels[frame.layer.ID]
+            yield frame, cell
+
+    def _create_spritesheet(self, index_path=None):
+        """
+        Export steps adding an atlas of the composited frames as a single
+        layer, one cell per frame whatever its hold. The cell and the hold of
+        every frame are written in an index table. When duplicates are
+        merged, each distinct cell is stored once.
+
+        Every frame is blitted into the atlas as soon as it is composited.
+        The atlas is allocated for the most cells it can get and cropped to
+        the cells used once duplicates are merged.
+        """
+        stacks = self._frame_stacks()
+        if not stacks:
+            return
 
-        elif format == 'spritesheet':
-            simg = gimp.Image(len(new_image.layers) * self.image.width,
-                              self.image.height, self.image.base_type)
+        dedupe = self.dedupe_frames
+        cw, ch = self.image.width, self.image.height
+        pad = self.sheet_padding
+
+        count = len(stacks)
+        columns = max(1, min(self.sheet_columns or count, count))
+        rows = int(math.ceil(count / float(columns)))
+        atlas = np.zeros((rows * ch + (rows - 1) * pad,
+                          columns * cw + (columns - 1) * pad, 4), dtype=np.uint8)
+
+        def slot(n):
+            r, c = divmod(n, columns)
+            x, y = c * (cw + pad), r * (ch + pad)
+            return atlas[y:y + ch, x:x + cw]
+
+        used, index, digests = 0, [], {}
+        for frame, cell in self._frame_cells(stacks):
+            n = None
+            if dedupe:
+                previous = (used - 1, slot(used - 1), (0, 0)) if used else None
+                n = self._duplicate_cell(cell, previous, digests, used)
+            if n is None:
+                slot(used)[...] = cell
+                n = used
+                used += 1
+            index.append(n)
+            yield
+
+        if dedupe:
+            columns = min(columns, used)
+            rows = int(math.ceil(used / float(columns)))
+            atlas = atlas[:rows * ch + (rows - 1) * pad, :columns * cw + (columns - 1) * pad]
+
+        simg = gimp.Image(atlas.shape[1], atlas.shape[0], RGB)
+        simg.disable_undo()
+        Pixels.write(simg, "spritesheet", atlas)
+        self._save_sheet_index(simg, self._sheet_index(stacks, index, columns, pad), index_path)
+        simg.enable_undo()
+        gimp.Display(simg)
+        yield
+
+    def _sheet_index(self, stacks, index, columns, pad):
+        """
+        Return the index table of a spritesheet, index being the cell of the
+        frame of every (frame, stack) of stacks.
+        """
+        return {
+            "cell": [self.image.width, self.image.height],
+            "columns": columns,
+            "padding": pad,
+            "frames": [{"name": frame.name, "cell": n, "hold": frame.ticks(self.framerate),
+                        "duration": int(round(frame.duration(self.framerate) * 1000))}
+                       for (frame, stack), n in zip(stacks, index)],
+        }
+
+    def _save_sheet_index(self, simg, table, path=None):
+        """
+        Keep the index table of the spritesheet simg in a parasite and, when
+        a path was chosen, in that JSON file, the sheet being named after it.
+        """
+        simg.attach_new_parasite(SHEET_INDEX_PARASITE, PARASITE_PERSISTENT, json.dumps(table))
+        if path is None:
+            return
+        pdb.gimp_image_set_filename(simg, os.path.splitext(path)[0] + ".png")
+        try:
+            with open(path, "w") as f:
+                json.dump(table, f, indent=1)
+        except (IOError, OSError) as e:
+            gimp.message("Could not save the spritesheet index table: %s" % e)
+
+    def _choose_sheet_index_path(self):
+        """
+        Ask where to save the index table of the spritesheet, None when
+        skipped: the table is then only kept in the sheet parasite.
+        """
+        dialog = Gtk.FileChooserDialog(title="Save Spritesheet Index", parent=self,
+                                       action=Gtk.FileChooserAction.SAVE)
+        dialog.add_buttons("Skip", Gtk.ResponseType.CANCEL,
+                           "Save", Gtk.ResponseType.ACCEPT)
+        dialog.set_do_overwrite_confirmation(True)
+
+        name = os.path.splitext(self.image.name)[0] or "animation"
+        if self.image.filename:
+            dialog.set_current_folder(os.path.dirname(self.image.filename))
+        dialog.set_current_name(name + SHEET_INDEX_SUFFIX + ".json")
+
+        path = None
+        if dialog.run() == Gtk.ResponseType.ACCEPT:
+            path = dialog.get_filename()
+            if not path.lower().endswith(".json"):
+                path += ".json"
+        dialog.destroy()
+        return path
+
+    def _choose_atlas_path(self):
+        """Ask where to save the atlas JSON, the pages going next to it."""
+        dialog = Gtk.FileChooserDialog(title="Save Texture Atlas", parent=self,
+                                       action=Gtk.FileChooserAction.SAVE)
+        dialog.add_buttons("Cancel", Gtk.ResponseType.CANCEL,
+                           "Save", Gtk.ResponseType.ACCEPT)
+        dialog.set_do_overwrite_confirmation(True)
+
+        name = os.path.splitext(self.image.name)[0] or "atlas"
+        if self.image.filename:
+            dialog.set_current_folder(os.path.dirname(self.image.filename))
+        dialog.set_current_name(name + ".json")
+
+        path = None
+        if dialog.run() == Gtk.ResponseType.ACCEPT:
+            path = dialog.get_filename()
+            if not path.lower().endswith(".json"):
+                path += ".json"
+        dialog.destroy()
+        return path
+
+    def _animation_writers(self):
+        """Return [(name, extension, writer class)] of the animated files that can be saved."""
+        writers = [("Animated PNG", ".png", ApngWriter)]
+        if PILImage is not None:
+            writers.append(("GIF animation", ".gif", GifWriter))
+        if WebpWriter.available():
+            writers.append(("Animated WebP", ".webp", WebpWriter))
+        return writers
+
+    def _choose_animation_path(self):
+        """Ask where to save the animation, return its path and writer class."""
+        dialog = Gtk.FileChooserDialog(title="Save Animation", parent=self,
+                                       action=Gtk.FileChooserAction.SAVE)
+        dialog.add_buttons("Cancel", Gtk.ResponseType.CANCEL,
+                           "Save", Gtk.ResponseType.ACCEPT)
+        dialog.set_do_overwrite_confirmation(True)
+
+        writers = self._animation_writers()
+        for name, extension, writer in writers:
+            f = Gtk.FileFilter()
+            f.set_name(name)
+            f.add_pattern("*" + extension)
+            dialog.add_filter(f)
+
+        name = os.path.splitext(self.image.name)[0] or "animation"
+        if self.image.filename:
+            dialog.set_current_folder(os.path.dirname(self.image.filename))
+        dialog.set_current_name(name + writers[-1][1])
+
+        result = None
+        if dialog.run() == Gtk.ResponseType.ACCEPT:
+            path = dialog.get_filename()
+            chosen = dialog.get_filter()
+            extension = os.path.splitext(path)[1].lower()
+            for name, ext, writer in writers:
+                if ext == extension:
+                    result = (path, writer)
+                    break
+            else:
+                for name, ext, writer in writers:
+                    if chosen is not None and chosen.get_name() == name:
+                        result = (path + ext, writer)
+                        break
+        dialog.destroy()
+        return result
+
+    def _write_animation(self, path, writer_class):
+        """
+        Export steps compositing one frame at a time and streaming it to an
+        animated file, with the frame durations at the configured framerate.
+        Frames showing the same pixels as the previous one lengthen it when
+        duplicates are merged.
+        """
+        stacks = self._frame_stacks()
+        if not stacks:
+            return
 
-            cnt = 0
+        dedupe = self.dedupe_frames
+        tolerance = self.dedupe_tolerance
+        writer = writer_class(path, self.image.width, self.image.height)
+        try:
+            pending = None
+            for frame, cell in self._frame_cells(stacks):
+                ms = frame.duration(self.framerate) * 1000.0
+                digest = hashlib.blake2b(cell.tobytes(), digest_size=16).digest() if dedupe else None
+                if pending is not None and dedupe and \
+                        (digest == pending[2] or
+                         (tolerance and Pixels.similar(pending[0], cell, tolerance))):
+                    pending[1] += ms
+                    yield
+                    continue
+
+                if pending is not None:
+                    writer.add(pending[0], pending[1])
+                pending = [cell, ms, digest]
+                yield
+
+            writer.add(pending[0], pending[1])
+            yield from writer.finish()
+        except BaseException:
+            writer.abort()
+            raise
+
+    def _pack_atlas(self, rects):
+        """
+        Pack the (width, height) rects, largest first, into as many pages as
+        needed. Return the pages as [width, height] and the (page, x, y) of
+        every rect. Rects larger than a page get a page of their own.
+        """
+        pad = self.sheet_padding
+        size = self.atlas_max_size
+        if self.atlas_pot:
+            # pages are rounded up to a power of two, keep that within the limit.
+            size = 1 << (max(1, size).bit_length() - 1)
+        bins = []
+        places = [None] * len(rects)
+
+        order = sorted(range(len(rects)), key=lambda i: (max(rects[i]), rects[i][0] * rects[i][1]),
+                       reverse=True)
+        for i in order:
+            w, h = rects[i][0] + pad, rects[i][1] + pad
+            for page, packer in enumerate(bins):
+                xy = packer.insert(w, h)
+                if xy is not None:
+                    places[i] = (page,) + xy
+                    break
+            else:
+                packer = MaxRects(max(size, w - pad) + pad, max(size, h - pad) + pad)
+                bins.append(packer)
+                places[i] = (len(bins) - 1,) + packer.insert(w, h)
+
+        pages = []
+        for packer in bins:
+            page = [max(1, packer.used_width - pad), max(1, packer.used_height - pad)]
+            if self.atlas_pot:
+                page = [1 << (n - 1).bit_length() for n in page]
+            pages.append(page)
+        return pages, places
+
+    def _create_atlas(self, path):
+        """
+        Export steps saving the composited frames trimmed to their opaque
+        pixels and packed into PNG pages, with a JSON file describing where
+        each frame is and where it goes back on the canvas.
+        """
+        stacks = self._frame_stacks()
+        if not stacks:
+            return
 
-            def novisible(x, state):
-                x.visible = state
+        # only the trimmed cells are kept, distinct ones when merging duplicates.
+        cells, trims, index, digests = [], [], [], {}
+        for frame, cell in self._frame_cells(stacks):
+            # fully transparent cells keep a single pixel, to stay addressable.
+            x, y, w, h = Pixels.bounds(cell) or (0, 0, 1, 1)
+            cell = cell[y:y + h, x:x + w].copy()
+            n = None
+            if self.dedupe_frames:
+                previous = (len(cells) - 1, cells[-1], trims[-1][:2]) if cells else None
+                n = self._duplicate_cell(cell, previous, digests, len(cells), (x, y))
+            if n is None:
+                n = len(cells)
+                cells.append(cell)
+                trims.append((x, y, w, h))
+            index.append(n)
+            yield
+
+        pages, places = self._pack_atlas([(w, h) for x, y, w, h in trims])
+        yield len(stacks) + 1 + len(pages)
+
+        base = os.path.splitext(path)[0]
+        names = ["%s-%d.png" % (os.path.basename(base), i) for i in range(len(pages))]
+        for page, (pw, ph) in enumerate(pages):
+            data = np.zeros((ph, pw, 4), dtype=np.uint8)
+            for cell, (x, y, w, h), place in zip(cells, trims, places):
+                if place[0] == page:
+                    px, py = place[1], place[2]
+                    data[py:py + h, px:px + w] = cell
+            Pixels.save_png(os.path.join(os.path.dirname(path), names[page]), data)
+            yield
+
+        atlas = {
+            "meta": {"app": NAME, "size": [self.image.width, self.image.height],
+                     "framerate": self.framerate, "pages": names},
+            "cells": [{"page": place[0], "x": place[1], "y": place[2], "w": w, "h": h,
+                       "offset_x": x, "offset_y": y}
+                      for (x, y, w, h), place in zip(trims, places)],
+            "frames": [{"name": frame.name, "cell": n,
+                        "duration": int(round(frame.duration(self.framerate) * 1000))}
+                       for (frame, stack), n in zip(stacks, index)],
+        }
+        with open(path, "w") as f:
+            json.dump(atlas, f, indent=1)
+        yield
+
+    def _duplicate_cell(self, cell, previous, digests, index, place=(0, 0)):
+        """
+        Return the index of the kept cell with the same pixels as cell, or of
+        previous, the (index, pixels, place) of the last kept cell, when
+        within the tolerance. None means cell is new and gets index. place
+        is where a trimmed cell goes on the canvas. digests maps the hash of
+        every kept cell to its index.
+        """
+        digest = hashlib.blake2b(struct.pack("<4i", cell.shape[1], cell.shape[0], *place),
+                                 digest_size=16)
+        digest.update(cell.tobytes())
+        digest = digest.digest()
+        n = digests.get(digest)
+        if n is not None:
+            return n
+        if self.dedupe_tolerance and previous is not None and previous[2] == tuple(place) and \
+                Pixels.similar(previous[1], cell, self.dedupe_tolerance):
+            return previous[0]
+        digests[digest] = index
+        return None
+
+    def _create_spritesheet_pdb(self, index_path=None):
+        stacks = self._frame_stacks()
+        new_image = yield from self._create_gif_image(merge=False)
+        simg = gimp.Image(len(stacks) * self.image.width,
+                          self.image.height, self.image.base_type)
+
+        cnt = 0
+
+        def novisible(x, state):
+            x.visible = state
 
+        try:
             n_img_layers = list(new_image.layers)
             n_img_layers.reverse()
 
@@ -746,45 +3350,77 @@ class Timeline(Gtk.Window):
                     novisible(x, False)
                 cl.visible = True
                 simg.merge_visible_layers(1)
-
-            for x in simg.layers:
-                novisible(x, True)
-            gimp.Display(simg)
-
-        if oskin_disabled:
-            self.on_onionskin(None)
+                yield
+        except BaseException:
+            pdb.gimp_image_delete(simg)
+            raise
+        finally:
+            pdb.gimp_image_delete(new_image)
+
+        for x in simg.layers:
+            novisible(x, True)
+        self._save_sheet_index(simg, self._sheet_index(stacks, range(cnt), max(1, cnt), 0),
+                               index_path)
+        gimp.Display(simg)
 
     def on_toggle_play(self, widget):
-        if self.oskin_onplay:
-            self.layers_show(False)
-
-        self.is_playing = not self.is_playing
-
         if self.is_playing:
-            if self.before_play is None:
-                self.before_play = self.active
-
-            widget.set_image(self.play_button_images[1])
-
-            if not self.player:
-                self.player = Player(self, widget)
-            self._toggle_enable_buttons(PLAYING)
-            self.player.start()
+            self._stop_playing()
+            # catch up with what was changed from GIMP meanwhile, the frame
+            # shown before playing may be gone once the frames are rescanned.
+            signature = self._signature
+            self._check_image()
+            if self._signature != signature or self.image not in gimp.image_list():
+                self.before_play = None
+                return
+            with self.transaction():
+                if self.before_play is not None:
+                    self.on_goto(None, POS, index=self.before_play)
+                    self.before_play = None
+                self.on_goto(None, NOWHERE)
+            return
 
+        self.is_playing = True
+        if self.before_play is None:
+            self.before_play = self.active
+
+        widget.set_image(self.play_button_images[1])
+
+        if not self.player:
+            self.player = Player(self, widget)
+        self._toggle_enable_buttons(PLAYING)
+        if self.prerender:
+            # the player starts once the proxies are ready.
+            alloc = self.preview.get_allocation()
+            self.export_job = ExportJob(self.playback_cache.prepare(alloc.width, alloc.height),
+                                        len(self.frames), self.export_progress,
+                                        self.on_proxies_ready, "Preparing the proxies")
+            self.export_bar.show()
+            self.export_job.start()
         else:
-            if self.before_play is not None:
-                self.on_goto(None, POS, index=self.before_play)
-                self.before_play = None
+            self.player.start()
 
-            widget.set_image(self.play_button_images[0])
-            self._toggle_enable_buttons(PLAYING)
-            self.on_goto(None, NOWHERE)
+    def _stop_playing(self):
+        """Stop the player, leaving the layers as they are."""
+        self.is_playing = False
+        if self.export_job is not None:
+            # stopped while the proxies were prepared, nothing else runs
+            # a job during playback.
+            job, self.export_job = self.export_job, None
+            job.cancel()
+            self.export_bar.hide()
+        self.player.stop()
+        self.player.play_button.set_image(self.play_button_images[0])
+        self._toggle_enable_buttons(PLAYING)
+
+    def on_toggle_stats(self, widget):
+        self.show_stats = widget.get_active()
+        self.stats_label.set_visible(self.show_stats)
 
     def on_replay(self, widget):
         self.is_replay = widget.get_active()
 
     def on_onionskin(self, widget):
-        self.layers_show(False)
         if widget is None:
             self.oskin = not self.oskin
         else:
@@ -797,148 +3433,377 @@ class Timeline(Gtk.Window):
 
         if result == Gtk.ResponseType.APPLY:
             self.set_settings(config)
+            self.preview.set_visible(self.prerender or self._overlay_mode())
+            if self.frames:
+                self.on_goto(None, NOWHERE)
         dialog.destroy()
 
+    def selected_range(self):
+        """
+        Return the first and last index of the frames the frame operations
+        work on, the selected range when it holds the active frame.
+        """
+        selection = self.frame_bar.selection
+        if selection and selection[0] <= self.active <= selection[1]:
+            return selection
+        return self.active, self.active
+
+    def _rescan(self, active, selection=None):
+        """Single reconciliation after a frame operation changed the stack."""
+        with self.transaction():
+            self._scan_image_layers()
+            self.frame_bar.set_selection(selection)
+            self.on_goto(None, POS, index=min(active, len(self.frames) - 1))
+
+    def move_range(self, first, last, to):
+        """Move the frames first to last so that the first one lands at index to."""
+        block = self.frames[first:last + 1]
+        count = len(self.frames)
+        if to == first or to < 0 or to + len(block) > count:
+            return
+
+        # each layer is moved straight to its place, in the order that keeps
+        # the ones already placed from shifting.
+        order = range(len(block))
+        if to > first:
+            order = reversed(order)
+
+        self.image.undo_group_start()
+        try:
+            for k in order:
+                pdb.gimp_image_reorder_item(self.image, block[k].layer, None,
+                                            count - 1 - (to + k))
+        finally:
+            self.image.undo_group_end()
+
+        selection = (to, to + last - first) if last > first else None
+        self._rescan(self.active - first + to, selection)
+
     def on_move(self, widget, direction):
-        index = 0
+        first, last = self.selected_range()
         if direction == NEXT:
-            index = self.active + 1
-            if index == len(self.frames):
-                return
+            self.move_range(first, last, first + 1)
         elif direction == PREV:
-            index = self.active - 1
-            if self.active - 1 < 0:
-                return
+            self.move_range(first, last, first - 1)
 
-        if direction == NEXT:
-            self.image.raise_layer(self.frames[self.active].layer)
-        elif direction == PREV:
-            self.image.lower_layer(self.frames[self.active].layer)
+    def on_move_to(self, widget, index):
+        first, last = self.selected_range()
+        if index > last:
+            self.move_range(first, last, index - (last - first))
+        elif index < first:
+            self.move_range(first, last, index)
 
-        self._scan_image_layers()
-        self.active = index
-        self.on_goto(None, NOWHERE)
+    def on_select_range(self, widget, index):
+        self.frame_bar.set_selection((min(self.active, index), max(self.active, index)))
 
     def on_remove(self, widget):
         if not self.frames:
             return
 
-        index = 0
-        if self.active > 0:
-            self.on_goto(None, PREV, True)
-            index = self.active + 1
+        first, last = self.selected_range()
+        block = self.frames[first:last + 1]
 
-        self.image.remove_layer(self.frames[index].layer)
-        self.frame_bar.remove(self.frames[index])
-        self.frames[index].destroy()
-        self.frames.remove(self.frames[index])
+        self.image.undo_group_start()
+        try:
+            for frame in block:
+                self._forget_frame(frame)
+                self.image.remove_layer(frame.layer)
+        finally:
+            self.image.undo_group_end()
 
-        if len(self.frames) == 0:
+        if len(block) == len(self.frames):
+            self.frames = []
+            self._frame_index = {}
+            self.frame_bar.set_frames(self.frames)
+            self._index_playable()
             self._toggle_enable_buttons(NO_FRAMES)
-        else:
-            self.on_goto(None, None, True)
-        self.on_window_focus(None, None)
+            self._check_image()
+            return
 
-    def on_add(self, widget, copy=False):
-        self.image.undo_group_start()
+        self._rescan(max(0, first - 1))
 
-        name = "Frame " + str(len(self.frames))
-        l = None
-        if not copy:
-            l = gimp.Layer(self.image, name, self.image.width,
-                           self.image.height, RGBA_IMAGE, 100, NORMAL_MODE)
+    def on_add(self, widget, copy=False):
+        if not self.frames:
+            if copy:
+                return
+            first, last = 0, -1
         else:
-            l = self.frames[self.active].layer.copy()
-            l.name = name
-
-        self.image.add_layer(l, len(self.image.layers) - self.active - 1)
-        if self.new_layer_type == TRANSPARENT_FILL and not copy:
-            pdb.gimp_edit_clear(l)
+            first, last = self.selected_range()
+        added = max(1, last - first + 1)
+        position = self.stack_position(last)
 
-        self._scan_image_layers()
-        self.on_goto(None, NEXT, True)
-
-        if len(self.frames) == 1:
+        self.image.undo_group_start()
+        try:
+            for k in range(added):
+                name = "Frame " + str(len(self.frames) + k)
+                if not copy:
+                    l = gimp.Layer(self.image, name, self.image.width,
+                                   self.image.height, RGBA_IMAGE, 100, NORMAL_MODE)
+                else:
+                    l = self.frames[first + k].layer.copy()
+                    l.name = name
+
+                # every layer goes above the previous one, after the range.
+                self.image.add_layer(l, position)
+                if self.new_layer_type == TRANSPARENT_FILL and not copy:
+                    pdb.gimp_edit_clear(l)
+        finally:
+            self.image.undo_group_end()
+
+        was_empty = not self.frames
+        selection = (last + 1, last + added) if added > 1 else None
+        self._rescan(last + 1, selection)
+
+        if was_empty:
             self._toggle_enable_buttons(NO_FRAMES)
 
-        self.image.undo_group_end()
+    def on_click_goto(self, widget, index):
+        self.frame_bar.set_selection(None)
+        self.request_frame(index)
+
+    def request_frame(self, index, update=False):
+        """
+        Ask to show the frame at index. Requests made before the next redraw
+        of the window are merged, only the last frame asked is shown.
+        """
+        self._scrub_target = index
+        self._scrub_update = self._scrub_update or update
+        if self._scrub_pending:
+            return
+
+        self._scrub_pending = True
+        if self.get_mapped():
+            self.add_tick_callback(self._on_scrub_tick)
+        else:
+            GLib.idle_add(self._on_scrub_tick)
 
-    def on_click_goto(self, widget, event):
-        i = self.frames.index(widget)
-        self.on_goto(None, POS, index=i)
+    def request_step(self, step, update=False):
+        """Ask to move step playable frames from the last frame asked."""
+        if not self.frames:
+            return
+        base = self._scrub_target if self._scrub_pending else self.active
+        index = self.playable_step(base, step)
+        if index is None:
+            index = (base + step) % len(self.frames)
+        self.request_frame(index, update)
+
+    def _on_scrub_tick(self, *args):
+        self._scrub_pending = False
+        index, update = self._scrub_target, self._scrub_update
+        self._scrub_target, self._scrub_update = None, False
+        if self.frames and not self.is_playing:
+            self.on_goto(None, POS, update, index=min(index, len(self.frames) - 1))
+        return False
+
+    def _sync_scrubber(self):
+        adjustment = self.scrubber.get_adjustment()
+        self._scrub_syncing = True
+        adjustment.set_upper(max(0, len(self.frames) - 1))
+        adjustment.set_value(self.active)
+        self._scrub_syncing = False
+
+    def on_scrub(self, widget):
+        if not self._scrub_syncing:
+            self.request_frame(int(round(widget.get_value())))
+
+    def on_step(self, widget, step):
+        self.request_step(step, True)
+
+    def on_key_press(self, widget, event):
+        # leave the keys to the entries, like the hold popover's spin buttons.
+        if (isinstance(self.get_focus(), Gtk.Entry) or self.is_playing or
+                self.load_job is not None or self.export_job is not None or not self.frames):
+            return False
+
+        key = event.keyval
+        if key in (Gdk.KEY_Right, Gdk.KEY_period):
+            self.request_step(1)
+        elif key in (Gdk.KEY_Left, Gdk.KEY_comma):
+            self.request_step(-1)
+        elif key == Gdk.KEY_Home:
+            self.request_frame(self.playable[0] if self.playable else 0)
+        elif key == Gdk.KEY_End:
+            self.request_frame(self.playable[-1] if self.playable else len(self.frames) - 1)
+        else:
+            return False
+        return True
+
+    def on_hold_changed(self, widget, index, delta):
+        frame = self.frames[index]
+        # a hold in milliseconds is only changed from the popover.
+        frame.set_hold(frame.hold + delta, frame.hold_ms)
+        self.frame_bar.queue_draw()
+
+    def on_hold_edit(self, widget, index):
+        """Popover to set the hold of a frame in ticks or milliseconds."""
+        frame = self.frames[index]
+
+        popover = Gtk.Popover(relative_to=self.frame_bar)
+        popover.set_pointing_to(self.frame_bar.cell_rect(index))
+
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        ticks, ticks_adj = Utils.spin_button("Hold", 'int', frame.hold, 1, HOLD_MAX)
+        ms, ms_adj = Utils.spin_button("ms", 'int', frame.hold_ms or 0, 0, HOLD_MAX_MS, 10)
+        ms.set_tooltip_text("duration in milliseconds, 0 holds for a number of frames instead.")
+        box.pack_start(ticks, False, False, 2)
+        box.pack_start(ms, False, False, 2)
+        popover.add(box)
+
+        def on_changed(adjustment):
+            frame.set_hold(ticks_adj.get_value(), ms_adj.get_value())
+            self.frame_bar.queue_draw()
+
+        ticks_adj.connect("value_changed", on_changed)
+        ms_adj.connect("value_changed", on_changed)
+        popover.show_all()
+
+    def on_toggle_fix(self, widget, index):
+        frame = self.frames[index]
+        frame.set_fixed(not frame.fixed)
+        self._index_playable()
+        self.frame_bar.queue_draw()
+
+    def show_frame(self, index):
+        """Show a frame for the playback, on the preview or on the canvas."""
+        if self.prerender:
+            self.preview.show_pixbuf(self.playback_cache.get(self.frames[index]))
+        else:
+            self.on_goto(None, POS, index=index)
 
     def on_goto(self, widget, to, update=False, index=0):
-        self.layers_show(False)
+        with self.transaction():
+            self._goto(to, update, index)
 
+    def _goto(self, to, update, index):
         if update:
             self.frames[self.active].update_layer_info()
+            self.frame_bar.queue_draw()
 
+        # the buttons jump over fixed frames, unless every frame is fixed.
         if to == START:
-            self.active = 0
+            self.active = self.playable[0] if self.playable else 0
         elif to == END:
-            self.active = len(self.frames) - 1
+            self.active = self.playable[-1] if self.playable else len(self.frames) - 1
         elif to == NEXT:
-            i = self.active + 1
-            if i > len(self.frames) - 1:
-                i = 0
+            i = self.playable_step(self.active, 1)
+            if i is None:
+                i = (self.active + 1) % len(self.frames)
             self.active = i
         elif to == PREV:
-            i = self.active - 1
-            if i < 0:
-                i = len(self.frames) - 1
+            i = self.playable_step(self.active, -1)
+            if i is None:
+                i = (self.active - 1) % len(self.frames)
             self.active = i
         elif to == POS:
             self.active = index
         elif to == GIMP_ACTIVE:
-            if self.image.active_layer in self.image.layers:
-                self.active = list(self.image.layers).index(self.image.active_layer)
-                self.active = len(self.image.layers) - 1 - self.active
+            active = self.image.active_layer
+            # the onion skin overlay is no frame, and neither is a channel or
+            # a path selected in GIMP: stay where the timeline is.
+            if active is not None:
+                self.active = self._frame_index.get(active.ID, self.active)
+
+        self.layers_show()
+
+        layer = self.frames[self.active].layer
+        if layer.ID != self._active_layer_id:
+            self.image.active_layer = layer
+            self._active_layer_id = layer.ID
+
+    def _onion_neighbours(self):
+        """
+        Return [(frame, opacity, past)] of the frames the onion skin shows
+        around the active one, the nearest first.
+        """
+        active = self.frames[self.active]
+        if not self.oskin or active.fixed or (self.is_playing and not self.oskin_onplay):
+            return []
+
+        neighbours = []
+        for i in range(1, self.oskin_depth + 1):
+            if self.oskin_falloff:
+                opacity = self.oskin_max_opacity * self.oskin_falloff ** (i - 1)
+            elif i == 1:
+                opacity = self.oskin_max_opacity
             else:
-                self.active = 0
-
-        self.layers_show(True)
-        self.image.active_layer = self.frames[self.active].layer
-        gimp.displays_flush()
-
-    def layers_show(self, state):
-        self.undo(False)
-
-        self.frames[self.active].layer.opacity = 100.0
-
-        if not state:
-            opacity = 100.0
+                opacity = self.oskin_max_opacity // i - 2
+            for pos, enabled, past in ((self.active - i, self.oskin_backward, True),
+                                       (self.active + i, self.oskin_forward, False)):
+                if enabled and 0 <= pos < len(self.frames):
+                    if not self.frames[pos].fixed:
+                        neighbours.append((self.frames[pos], opacity, past))
+        return neighbours
+
+    def _visibility_plan(self, neighbours):
+        """
+        Return {frame: (visible, opacity)} for the active frame and the onion
+        skin neighbours that must be shown with it.
+        """
+        plan = {self.frames[self.active]: (True, 100.0)}
+        for frame, opacity, past in neighbours:
+            plan[frame] = (True, opacity)
+        return plan
+
+    def _set_layer_state(self, layer, visible, opacity):
+        """Set layer visibility and opacity, skipping values already set."""
+        old = self._layer_state.get(layer.ID)
+        if old is None or old[0] != visible:
+            layer.visible = visible
+        if old is None or old[1] != opacity:
+            layer.opacity = opacity
+        self._layer_state[layer.ID] = (visible, opacity)
+
+    def _forget_frame(self, frame):
+        self._layer_state.pop(frame.layer.ID, None)
+        self._shown.pop(frame, None)
+        if self._highlighted is frame:
+            self._highlighted = None
+
+    def layers_show(self):
+        """
+        Show the active frame with its onion skin and hide the frames that
+        left the onion skin window, writing only the properties that change.
+        """
+        start = time.monotonic()
+        with self.transaction():
+            self._apply_visibility()
+        if self.stats is not None:
+            # the flush of an outer transaction is measured on its own.
+            self.stats.add("layers_show", time.monotonic() - start)
+
+    def _overlay_mode(self):
+        """Whether the onion skin is also drawn tinted in the preview."""
+        return self.oskin_overlay and np is not None
+
+    def _apply_visibility(self):
+        neighbours = self._onion_neighbours()
+        overlay = self._overlay_mode()
+        plan = self._visibility_plan(neighbours)
+
+        for frame in self._shown:
+            if frame not in plan:
+                # fixed frames stay visible to the playback.
+                self._set_layer_state(frame.layer, frame.fixed, 100.0)
+
+        for frame, (visible, opacity) in plan.items():
+            self._set_layer_state(frame.layer, visible, opacity)
+
+        if overlay and neighbours:
+            self.onion.show(self.frames[self.active], neighbours)
         else:
-            opacity = self.oskin_max_opacity
-
-        self.frames[self.active].layer.visible = state
-        self.frames[self.active].highlight(state)
-
-        is_fixed = self.frames[self.active].fixed
-
-        if (self.oskin and not is_fixed) and not (self.is_playing and not self.oskin_onplay):
-            for i in range(1, self.oskin_depth + 1):
-                o = opacity
-                if i > 1 and state:
-                    o = opacity // i - 1 * 2  # integer division
-
-                pos = self.active - i
-                if self.oskin_backward and pos >= 0:
-                    is_fixed = self.frames[pos].fixed
-                    if not is_fixed:
-                        self.frames[pos].layer.visible = state
-                        self.frames[pos].layer.opacity = o
-
-                pos = self.active + i
-                if self.oskin_forward and pos <= len(self.frames) - 1:
-                    is_fixed = self.frames[pos].fixed
-                    if not is_fixed:
-                        self.frames[pos].layer.visible = state
-                        self.frames[pos].layer.opacity = o
-
-        if self.frames[self.active].fixed and state == False:
-            self.frames[self.active].layer.visible = True
-
-        self.undo(True)
+            self.onion.hide()
+
+        active = self.frames[self.active]
+        if self._highlighted is not active:
+            if self._highlighted is not None:
+                self._highlighted.highlight(False)
+            active.highlight(True)
+            self._highlighted = active
+            self.frame_bar.show_index(self.active)
+            self.frame_bar.queue_draw()
+        self._sync_scrubber()
+
+        self._shown = plan
 
 
 def timeline_main(image, drawable):
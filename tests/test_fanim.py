@@ -0,0 +1,1044 @@
+# -*- coding: utf-8 -*-
+
+"""
+Headless checks of the FAnim plug-in, run against the fake gimpfu module.
+
+They need PyGObject, pycairo and numpy, as the plug-in does, but no
+display: no window is opened, the timeline methods are run on small
+stand-ins.
+
+    python3 -m pytest tests
+"""
+
+import io
+import itertools
+import json
+import os
+import struct
+import sys
+import zlib
+from contextlib import nullcontext
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("gi")
+pytest.importorskip("cairo")
+np = pytest.importorskip("numpy")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+sys.path.insert(1, ROOT)
+
+import fake_gimpfu
+sys.modules["gimpfu"] = fake_gimpfu
+
+import fanim
+from fanim import GIMP_ACTIVE, NOWHERE, POS
+
+
+def overlaps(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    return ax < bx + bw and bx < ax + aw and ay < by + bh and by < ay + ah
+
+
+def random_rects(count, largest, seed=7):
+    rng = np.random.RandomState(seed)
+    return [(int(w), int(h)) for w, h in rng.randint(1, largest + 1, size=(count, 2))]
+
+
+def png_chunks(data):
+    """Return the (kind, data) of every chunk of a PNG, checking their CRC."""
+    assert data[:8] == fanim.ApngWriter.SIGNATURE
+    chunks, pos = [], 8
+    while pos < len(data):
+        length, = struct.unpack(">I", data[pos:pos + 4])
+        kind = data[pos + 4:pos + 8]
+        body = data[pos + 8:pos + 8 + length]
+        crc, = struct.unpack(">I", data[pos + 8 + length:pos + 12 + length])
+        assert crc == zlib.crc32(kind + body) & 0xffffffff
+        chunks.append((kind, body))
+        pos += 12 + length
+    return chunks
+
+
+def unfilter_up(compressed, width, height):
+    raw = np.frombuffer(zlib.decompress(compressed), dtype=np.uint8).reshape(height, width * 4 + 1)
+    assert (raw[:, 0] == 2).all()
+    rows = raw[:, 1:].copy()
+    for y in range(1, height):
+        rows[y] += rows[y - 1]
+    return rows.reshape(height, width, 4)
+
+
+def gif_delays(data):
+    """Return the delays of the graphic control extensions of a gif."""
+    delays, pos = [], 0
+    while True:
+        pos = data.find(b"\x21\xf9\x04", pos)
+        if pos < 0:
+            return delays
+        delays.append(struct.unpack("<H", data[pos + 4:pos + 6])[0])
+        pos += 8
+
+
+# MaxRects and atlas pages
+
+def test_maxrects_places_within_the_bin_without_overlaps():
+    packer = fanim.MaxRects(64, 48)
+    placed = []
+    for w, h in random_rects(60, 16):
+        xy = packer.insert(w, h)
+        if xy is None:
+            continue
+        rect = xy + (w, h)
+        assert rect[0] >= 0 and rect[1] >= 0
+        assert rect[0] + w <= 64 and rect[1] + h <= 48
+        assert not any(overlaps(rect, other) for other in placed)
+        placed.append(rect)
+
+    assert placed
+    assert packer.used_width == max(x + w for x, y, w, h in placed)
+    assert packer.used_height == max(y + h for x, y, w, h in placed)
+
+
+def test_maxrects_refuses_what_does_not_fit():
+    packer = fanim.MaxRects(10, 10)
+    assert packer.insert(11, 1) is None
+    assert packer.insert(10, 10) == (0, 0)
+    assert packer.insert(1, 1) is None
+
+
+@pytest.mark.parametrize("pot", [False, True])
+@pytest.mark.parametrize("pad", [0, 2])
+def test_pack_atlas_pages_hold_their_rects(pot, pad):
+    settings = SimpleNamespace(sheet_padding=pad, atlas_max_size=100, atlas_pot=pot)
+    rects = random_rects(80, 40) + [(130, 20)]
+    pages, places = fanim.Timeline._pack_atlas(settings, rects)
+
+    assert len(places) == len(rects)
+    by_page = {}
+    for (w, h), (page, x, y) in zip(rects, places):
+        pw, ph = pages[page]
+        assert x + w <= pw and y + h <= ph
+        rect = (x, y, w + pad, h + pad)
+        assert not any(overlaps(rect, other) for other in by_page.get(page, []))
+        by_page.setdefault(page, []).append(rect)
+
+    for page, (pw, ph) in enumerate(pages):
+        fits = all(w <= 64 and h <= 64 for (w, h), p in zip(rects, places) if p[0] == page)
+        if pot:
+            assert pw & (pw - 1) == 0 and ph & (ph - 1) == 0
+            if fits:
+                assert pw <= 64 and ph <= 64
+        elif fits:
+            assert pw <= 100 and ph <= 100
+
+    # the rect larger than a page gets a page sized for it.
+    assert pages[places[-1][0]][0] >= 130
+
+
+# animated file writers
+
+def frames_rgba(count, width=5, height=4):
+    frames = []
+    data = np.zeros((height, width, 4), dtype=np.uint8)
+    data[..., 3] = 255
+    for i in range(count):
+        data = data.copy()
+        if i:
+            data[1:3, 2:4, 0] = 40 * i
+        frames.append(data)
+    return frames
+
+
+def test_apng_stream(tmp_path):
+    path = str(tmp_path / "a.png")
+    first, second = frames_rgba(2)
+    writer = fanim.ApngWriter(path, 5, 4)
+    writer.add(first, 40)
+    writer.add(first, 80)
+    writer.add(second, 70000)
+    list(writer.finish())
+
+    with open(path, "rb") as f:
+        chunks = png_chunks(f.read())
+    kinds = [kind for kind, body in chunks]
+    assert kinds == [b"IHDR", b"acTL", b"fcTL", b"IDAT", b"fcTL", b"fdAT", b"fcTL", b"fdAT",
+                     b"IEND"]
+    assert struct.unpack(">II", chunks[1][1]) == (3, 0)
+
+    controls = [struct.unpack(">IIIIIHHBB", body) for kind, body in chunks if kind == b"fcTL"]
+    data = [body for kind, body in chunks if kind in (b"IDAT", b"fdAT")]
+    sequence = [c[0] for c in controls] + [struct.unpack(">I", d[:4])[0] for d in data[1:]]
+    assert sorted(sequence) == list(range(5))
+
+    # seq, width, height, x, y, delay numerator and denominator
+    assert controls[0][:7] == (0, 5, 4, 0, 0, 40, 1000)
+    assert controls[1][1:7] == (1, 1, 0, 0, 80, 1000)
+    assert controls[2][1:7] == (2, 2, 2, 1, 7000, 100)
+
+    assert (unfilter_up(data[0], 5, 4) == first).all()
+    assert (unfilter_up(data[2][4:], 2, 2) == second[1:3, 2:4]).all()
+
+
+def test_gif_stream(tmp_path):
+    PILImage = pytest.importorskip("PIL.Image")
+    path = str(tmp_path / "a.gif")
+    first, second = frames_rgba(2)
+    first[0, 0, 3] = 0
+    writer = fanim.GifWriter(path, 5, 4)
+    for data in (first, second, second):
+        writer.add(data, 1000 / 30.0)
+    list(writer.finish())
+
+    with open(path, "rb") as f:
+        data = f.read()
+    assert data[:6] == b"GIF89a"
+    assert struct.unpack("<HH", data[6:10]) == (5, 4)
+    assert b"NETSCAPE2.0" in data
+    assert data[-1:] == b"\x3b"
+    # rounded on the running time: 3.33, 6.67 and 10 hundredths.
+    assert gif_delays(data) == [3, 4, 3]
+
+    with PILImage.open(io.BytesIO(data)) as gif:
+        assert gif.n_frames == 3
+        gif.seek(0)
+        assert gif.convert("RGBA").getpixel((0, 0))[3] == 0
+        gif.seek(1)
+        assert gif.convert("RGB").getpixel((2, 1)) == (40, 0, 0)
+
+
+# playback timing
+
+class PlayerTimeline:
+    """What the player uses of the timeline."""
+
+    playable_step = fanim.Timeline.playable_step
+
+    def __init__(self, holds, framerate=10, drop_frames=True):
+        image = fake_gimpfu.make_image(len(holds), 4, 4)
+        cache = fanim.ThumbnailCache()
+        self.frames = [fanim.AnimFrame(l, cache) for l in reversed(image.layers)]
+        for frame, hold in zip(self.frames, holds):
+            frame.set_hold(hold)
+        self.playable = list(range(len(holds)))
+        self._playable_rank = {i: i for i in self.playable}
+        self.framerate = framerate
+        self.drop_frames = drop_frames
+        self.is_playing = True
+        self.is_replay = False
+        self.active = len(holds) - 1
+        self.show_stats = False
+        self.fps_label = self.stats_label = SimpleNamespace(set_text=lambda text: None)
+        self.stats = None
+        self.shown = []
+
+    def show_frame(self, index):
+        self.shown.append(index)
+
+    def on_toggle_play(self, widget):
+        self.is_playing = False
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(fanim.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(fanim.Player, "_schedule", lambda self: None)
+    return now
+
+
+def play(timeline, clock, at):
+    """Start a player and tick it at the given times."""
+    player = fanim.Player(timeline, None)
+    player.start()
+    for t in at:
+        clock[0] = t
+        player._tick()
+    return player
+
+
+def test_player_holds_frames(clock):
+    timeline = PlayerTimeline([1, 3, 1])
+    player = play(timeline, clock, [0.0, 0.1, 0.4])
+    # started on the last frame, it plays from the first one.
+    assert timeline.shown == [0, 1, 2]
+    assert player._deadline == pytest.approx(0.5)
+
+    clock[0] = 0.5
+    player._tick()
+    assert timeline.shown == [0, 1, 2]
+    assert not timeline.is_playing
+
+
+def test_player_drops_late_frames(clock):
+    timeline = PlayerTimeline([1] * 5)
+    player = play(timeline, clock, [0.0, 0.35])
+    assert timeline.shown == [0, 3]
+    assert player.dropped == 2
+    assert player._deadline == pytest.approx(0.4)
+
+
+def test_player_shows_every_frame_late(clock):
+    timeline = PlayerTimeline([1] * 5, drop_frames=False)
+    player = play(timeline, clock, [0.0, 0.35])
+    assert timeline.shown == [0, 1]
+    assert player.late == 1
+    assert player._deadline == pytest.approx(0.45)
+
+
+def test_player_wraps_with_repeat(clock):
+    timeline = PlayerTimeline([1] * 3)
+    timeline.is_replay = True
+    timeline.active = 0
+    play(timeline, clock, [0.0, 0.1, 0.2, 0.3])
+    assert timeline.shown == [1, 2, 0, 1]
+
+
+# frame operations
+
+def stack_order(image):
+    """Layer IDs in timeline order, the bottom layer being the first frame."""
+    return [l.ID for l in reversed(image.layers)]
+
+
+@pytest.mark.parametrize("first, last, to", [
+    (0, 0, 3), (4, 4, 0), (1, 2, 3), (3, 4, 0), (2, 4, 1), (0, 5, 0),
+])
+def test_move_range(first, last, to):
+    image = fake_gimpfu.make_image(6, 4, 4)
+    cache = fanim.ThumbnailCache()
+    rescans = []
+    timeline = SimpleNamespace(
+        image=image, active=first,
+        frames=[fanim.AnimFrame(l, cache) for l in reversed(image.layers)],
+        _rescan=lambda active, selection=None: rescans.append((active, selection)))
+
+    before = stack_order(image)
+    fanim.Timeline.move_range(timeline, first, last, to)
+
+    block = before[first:last + 1]
+    rest = before[:first] + before[last + 1:]
+    if to == first:
+        assert stack_order(image) == before and not rescans
+        return
+    assert stack_order(image) == rest[:to] + block + rest[to:]
+    selection = (to, to + last - first) if last > first else None
+    assert rescans == [(to, selection)]
+
+
+def test_move_range_out_of_bounds():
+    image = fake_gimpfu.make_image(4, 4, 4)
+    cache = fanim.ThumbnailCache()
+    timeline = SimpleNamespace(
+        image=image, active=0,
+        frames=[fanim.AnimFrame(l, cache) for l in reversed(image.layers)],
+        _rescan=lambda *args: pytest.fail("nothing was moved"))
+
+    before = stack_order(image)
+    fanim.Timeline.move_range(timeline, 2, 3, 3)
+    fanim.Timeline.move_range(timeline, 0, 0, -1)
+    assert stack_order(image) == before
+
+
+# timeline logic
+
+class FakeFrameBar:
+    """Frame strip showing the cells first to first + shown."""
+
+    def __init__(self, shown=8):
+        self.frames, self.shown, self.first = [], shown, 0
+
+    def set_frames(self, frames):
+        self.frames = frames
+
+    def visible_range(self):
+        return self.first, min(self.first + self.shown, len(self.frames))
+
+    def show_index(self, index):
+        pass
+
+    def queue_draw(self):
+        pass
+
+    def set_selection(self, selection):
+        pass
+
+
+class NavTimeline:
+    """Timeline without its widgets, running its layer and navigation logic."""
+
+    transaction = fanim.Timeline.transaction
+    undo = fanim.Timeline.undo
+    on_goto = fanim.Timeline.on_goto
+    _goto = fanim.Timeline._goto
+    layers_show = fanim.Timeline.layers_show
+    _apply_visibility = fanim.Timeline._apply_visibility
+    _onion_neighbours = fanim.Timeline._onion_neighbours
+    _visibility_plan = fanim.Timeline._visibility_plan
+    _set_layer_state = fanim.Timeline._set_layer_state
+    _forget_frame = fanim.Timeline._forget_frame
+    _overlay_mode = fanim.Timeline._overlay_mode
+    _scan_image_layers = fanim.Timeline._scan_image_layers
+    _reconcile_frames = fanim.Timeline._reconcile_frames
+    _image_signature = staticmethod(fanim.Timeline._image_signature)
+    _sync_layer_state = fanim.Timeline._sync_layer_state
+    _check_image = fanim.Timeline._check_image
+    _index_playable = fanim.Timeline._index_playable
+    playable_step = fanim.Timeline.playable_step
+    request_frame = fanim.Timeline.request_frame
+    request_step = fanim.Timeline.request_step
+    _on_scrub_tick = fanim.Timeline._on_scrub_tick
+    _load_frames = fanim.Timeline._load_frames
+    _mark = fanim.Timeline._mark
+
+    def __init__(self, image, scan=True):
+        self.image = image
+        self.thumbnails = fanim.ThumbnailCache()
+        self.thumb_store = SimpleNamespace(path=None, load=dict)
+        self.frame_bar = FakeFrameBar()
+        self.onion = SimpleNamespace(show=lambda active, neighbours: None, hide=lambda: None)
+        self.frames, self._frame_index, self.active = [], {}, 0
+        self._layer_state, self._shown, self._highlighted = {}, {}, None
+        self._active_layer_id, self._signature = None, None
+        self._transaction_depth, self.flush_count, self.stats = 0, 0, None
+        self.oskin, self.oskin_depth, self.oskin_falloff = False, 2, 0.0
+        self.oskin_max_opacity, self.oskin_onplay = fanim.OSKIN_MAX_OPACITY, False
+        self.oskin_backward = self.oskin_forward = True
+        self.oskin_overlay, self.is_playing = False, False
+        self.load_job = self.export_job = None
+        self._scrub_pending, self._scrub_target, self._scrub_update = False, None, False
+        self.ticks = []
+        self.startup, self._opened = {}, 0.0
+        if scan:
+            self._scan_image_layers()
+            self.on_goto(None, GIMP_ACTIVE)
+
+    def _sync_scrubber(self):
+        pass
+
+    def get_mapped(self):
+        return True
+
+    def add_tick_callback(self, callback):
+        self.ticks.append(callback)
+
+    def redraw(self):
+        """Run the callbacks of the next redraw of the window."""
+        ticks, self.ticks = self.ticks, []
+        for callback in ticks:
+            callback()
+
+    def destroy(self, widget):
+        pytest.fail("the image is still open")
+
+
+@pytest.fixture
+def writes(monkeypatch):
+    """Record the (layer ID, property, value) written to layers."""
+    written = []
+
+    def recorded(attribute):
+        def set(layer, value):
+            written.append((layer.ID, attribute.strip("_"), value))
+            setattr(layer, attribute, value)
+        return property(lambda layer: getattr(layer, attribute), set)
+    for attribute in ("_visible", "_opacity", "_mode"):
+        monkeypatch.setattr(fake_gimpfu.Layer, attribute.strip("_"), recorded(attribute))
+    return written
+
+
+def frame_ids(timeline):
+    return [f.layer.ID for f in timeline.frames]
+
+
+def test_reconcile_keeps_the_frames_left_unchanged(writes):
+    image = fake_gimpfu.make_image(6, 4, 4)
+    timeline = NavTimeline(image)
+    before = {f.layer.ID: f for f in timeline.frames}
+    assert frame_ids(timeline) == stack_order(image)
+
+    # a layer added, one removed and one moved from GIMP.
+    added = fake_gimpfu.Layer(image, "Frame 6", 4, 4)
+    image.insert_layer(added, None, 2)
+    removed = image.active_layer
+    assert removed.ID in timeline._layer_state
+    image.remove_layer(removed)
+    image.active_layer = image.layers[1]
+    image._reorder(image.layers[0], 3)
+    del writes[:]
+
+    timeline._scan_image_layers()
+    assert frame_ids(timeline) == stack_order(image)
+    assert timeline.frame_bar.frames is timeline.frames
+    for frame in timeline.frames:
+        if frame.layer.ID != added.ID:
+            assert frame is before[frame.layer.ID]
+    assert removed.ID not in timeline._frame_index
+    assert removed.ID not in timeline._layer_state
+    assert timeline._frame_index == {l: i for i, l in enumerate(frame_ids(timeline))}
+
+    # only the new layer is reset.
+    assert {layer for layer, attribute, value in writes} == {added.ID}
+
+
+def test_reconcile_follows_renames():
+    image = fake_gimpfu.make_image(3, 4, 4)
+    timeline = NavTimeline(image)
+    frame = timeline.frames[1]
+    frame.layer.name = "Background_fix"
+
+    timeline._scan_image_layers()
+    assert timeline.frames[1] is frame
+    assert frame.fixed and frame.name == "Background_fix"
+    assert timeline.playable == [0, 2]
+
+
+def test_goto_writes_only_what_changes(writes):
+    image = fake_gimpfu.make_image(8, 4, 4)
+    timeline = NavTimeline(image)
+    timeline.oskin = True
+    timeline.on_goto(None, POS, index=3)
+    layers = [f.layer for f in timeline.frames]
+    near, far = 50.0, 50.0 // 2 - 2
+    assert [(l.visible, l.opacity) for l in layers[1:6]] == \
+        [(True, far), (True, near), (True, 100.0), (True, near), (True, far)]
+
+    # one step: the frame leaving the onion skin is hidden, the one coming
+    # in is shown, the others only change their opacity.
+    del writes[:]
+    timeline.on_goto(None, POS, index=4)
+    assert sorted(writes) == sorted([
+        (layers[1].ID, "visible", False), (layers[1].ID, "opacity", 100.0),
+        (layers[2].ID, "opacity", far),
+        (layers[3].ID, "opacity", near),
+        (layers[4].ID, "opacity", 100.0),
+        (layers[5].ID, "opacity", near),
+        (layers[6].ID, "visible", True), (layers[6].ID, "opacity", far),
+    ])
+
+    # going nowhere writes nothing.
+    del writes[:]
+    timeline.on_goto(None, NOWHERE)
+    assert writes == []
+
+
+def test_visibility_changed_from_gimp_is_set_again(writes):
+    image = fake_gimpfu.make_image(4, 4, 4)
+    timeline = NavTimeline(image)
+    layer = timeline.frames[timeline.active].layer
+    layer.visible = False
+
+    # the shadow state still says visible until the focus check.
+    del writes[:]
+    timeline.on_goto(None, NOWHERE)
+    assert writes == []
+    timeline._check_image()
+    assert (layer.ID, "visible", True) in writes
+    assert {l for l, attribute, value in writes} == {layer.ID}
+
+
+def test_one_flush_per_action(monkeypatch):
+    image = fake_gimpfu.make_image(6, 4, 4)
+    timeline = NavTimeline(image)
+    timeline.oskin = True
+    calls = []
+    monkeypatch.setattr(fake_gimpfu.gimp, "displays_flush", lambda: calls.append("flush"))
+    monkeypatch.setattr(image, "undo_freeze", lambda: calls.append("freeze"))
+    monkeypatch.setattr(image, "undo_thaw", lambda: calls.append("thaw"))
+
+    def action(run):
+        del calls[:]
+        flushes = timeline.flush_count
+        run()
+        assert calls == ["freeze", "thaw", "flush"]
+        assert timeline.flush_count == flushes + 1
+
+    action(lambda: timeline.on_goto(None, POS, index=2))
+    action(lambda: timeline.on_goto(None, fanim.NEXT, update=True))
+    # a rescan and the goto after it.
+    image.remove_layer(image.layers[0])
+    action(timeline._check_image)
+    assert timeline._transaction_depth == 0
+
+
+# focus checks
+
+class FocusTimeline:
+    """The parts of Timeline following the changes made from GIMP."""
+
+    _check_image = fanim.Timeline._check_image
+    _image_signature = staticmethod(fanim.Timeline._image_signature)
+    _sync_layer_state = fanim.Timeline._sync_layer_state
+
+    def __init__(self, image, playing=False):
+        self.image = image
+        self.load_job = self.export_job = None
+        self.is_playing, self.before_play = playing, 0
+        self.thumbnails = fanim.ThumbnailCache()
+        self.frame_bar = SimpleNamespace(queue_draw=lambda: None)
+        self.active, self._active_layer_id = 0, image.active_layer.ID
+        self._layer_state = {l.ID: (l.visible, 100.0) for l in image.layers}
+        self._signature = self._image_signature(image.layers, [l.name for l in image.layers])
+        self.calls = []
+
+    def transaction(self):
+        return nullcontext()
+
+    def destroy(self, widget):
+        self.calls.append("destroy")
+
+    def _scan_image_layers(self, layers, names):
+        self.calls.append("rescan")
+        self._signature = self._image_signature(layers, names)
+
+    def on_goto(self, widget, to, index=None):
+        self.calls.append(to)
+
+    def _stop_playing(self):
+        self.calls.append("stop")
+        self.is_playing = False
+
+
+def test_check_image_waits_for_the_playback():
+    image = fake_gimpfu.make_image(4, 4, 4)
+    timeline = FocusTimeline(image, playing=True)
+
+    # hidden from GIMP, the frames played are left alone until it stops.
+    image.layers[1].visible = False
+    timeline._check_image()
+    assert timeline.calls == [] and timeline.is_playing
+
+    # removed, the player stops before the frames are rescanned.
+    image.remove_layer(image.layers[0])
+    timeline._check_image()
+    assert timeline.calls == ["stop", "rescan", fanim.GIMP_ACTIVE]
+    assert not timeline.is_playing and timeline.before_play is None
+
+
+def test_focus_rescans_only_when_the_stack_changed(monkeypatch, writes):
+    image = fake_gimpfu.make_image(5, 4, 4)
+    timeline = NavTimeline(image)
+    scans = []
+    scan = timeline._scan_image_layers
+    monkeypatch.setattr(timeline, "_scan_image_layers",
+                        lambda *args: scans.append(1) or scan(*args))
+
+    # clicked on the timeline, nothing changed.
+    del writes[:]
+    timeline._check_image()
+    assert not scans and not writes
+
+    # another layer picked in GIMP only moves the timeline.
+    image.active_layer = image.layers[3]
+    timeline._check_image()
+    assert not scans and timeline.frames[timeline.active].layer == image.layers[3]
+
+    # renamed, moved or removed layers are rescanned.
+    image.layers[2].name = "Frame 2_fix"
+    timeline._check_image()
+    image._reorder(image.layers[0], 2)
+    timeline._check_image()
+    image.remove_layer(image.layers[1])
+    timeline._check_image()
+    assert len(scans) == 3
+    assert frame_ids(timeline) == stack_order(image)
+
+
+def test_focus_checks_are_debounced(monkeypatch):
+    sources, removed = [], []
+
+    def timeout_add(interval, callback):
+        sources.append(callback)
+        return len(sources)
+    monkeypatch.setattr(fanim.GLib, "timeout_add", timeout_add)
+    monkeypatch.setattr(fanim.GLib, "source_remove", removed.append)
+
+    timeline = SimpleNamespace(_focus_source=None, checks=[])
+    timeline._on_focus_settled = lambda: fanim.Timeline._on_focus_settled(timeline)
+    timeline._check_image = lambda: timeline.checks.append(1)
+    for _ in range(3):
+        fanim.Timeline.on_window_focus(timeline, None, None)
+
+    assert removed == [1, 2] and timeline._focus_source == 3
+    assert sources[-1]() is False
+    assert timeline.checks == [1] and timeline._focus_source is None
+
+
+# scrubbing
+
+def test_scrub_requests_are_merged_until_the_redraw():
+    image = fake_gimpfu.make_image(10, 4, 4)
+    timeline = NavTimeline(image)
+    timeline.on_goto(None, POS, index=0)
+    flushes = timeline.flush_count
+
+    for index in (2, 5, 7):
+        timeline.request_frame(index)
+    assert len(timeline.ticks) == 1 and timeline.active == 0
+
+    timeline.redraw()
+    assert timeline.active == 7 and timeline.flush_count == flushes + 1
+    assert image.active_layer == timeline.frames[7].layer
+
+
+def test_scrub_steps_add_up():
+    image = fake_gimpfu.make_image(6, 4, 4, fixed_every=3)
+    timeline = NavTimeline(image)
+    assert timeline.playable == [0, 1, 3, 4]
+    timeline.on_goto(None, POS, index=0)
+
+    # fixed frames are stepped over, from the last frame asked.
+    for _ in range(3):
+        timeline.request_step(1)
+    timeline.redraw()
+    assert timeline.active == 4
+
+    # wrapping around.
+    timeline.request_step(1)
+    timeline.request_step(-2)
+    timeline.redraw()
+    assert timeline.active == 3
+
+
+def test_scrub_is_dropped_while_playing():
+    image = fake_gimpfu.make_image(4, 4, 4)
+    timeline = NavTimeline(image)
+    timeline.on_goto(None, POS, index=0)
+    timeline.request_frame(3)
+    timeline.is_playing = True
+    timeline.redraw()
+    assert timeline.active == 0 and not timeline._scrub_pending
+
+
+# progressive loading
+
+def run_steps(steps, count=None):
+    """Run count steps of an export job generator, all by default; return its result."""
+    try:
+        for _ in itertools.count() if count is None else range(count):
+            next(steps)
+    except StopIteration as stop:
+        return stop.value
+
+
+def test_load_frames_visible_cells_first(monkeypatch):
+    monkeypatch.setattr(fanim, "LOAD_BATCH", 4)
+    image = fake_gimpfu.make_image(40, 4, 4)
+    image.active_layer = image.layers[10]
+    timeline = NavTimeline(image, scan=False)
+    timeline.frame_bar.first = 20
+
+    steps = timeline._load_frames()
+    assert next(steps) == 41
+    # placeholders for every layer, none read yet.
+    assert frame_ids(timeline) == stack_order(image)
+    assert not any(f.loaded for f in timeline.frames)
+    assert timeline.active == 29 and "placeholders" in timeline.startup
+
+    run_steps(steps, 8)
+    assert [i for i, f in enumerate(timeline.frames) if f.loaded] == list(range(20, 28))
+    assert "visible_ready" not in timeline.startup
+
+    # then outward from the active frame, skipping the ones read.
+    run_steps(steps, 3)
+    assert [i for i, f in enumerate(timeline.frames) if f.loaded] == list(range(20, 31))
+    assert "visible_ready" in timeline.startup
+
+    assert run_steps(steps) is True
+    assert all(f.loaded for f in timeline.frames)
+    assert [f.name for f in timeline.frames] == [l.name for l in reversed(image.layers)]
+    assert timeline._signature == timeline._image_signature(image.layers,
+                                                            [l.name for l in image.layers])
+    assert list(timeline.startup) == ["placeholders", "visible_ready", "frames_ready"]
+    assert timeline.frames[timeline.active].layer == image.layers[10]
+
+
+def test_load_frames_stops_when_the_stack_changes():
+    image = fake_gimpfu.make_image(40, 4, 4)
+    timeline = NavTimeline(image, scan=False)
+    steps = timeline._load_frames()
+    run_steps(steps, 3)
+
+    image.remove_layer(image.layers[5])
+    assert run_steps(steps) is False
+
+
+# thumbnails
+
+class FakePixbuf:
+    """Thumbnail holding a copy of the layer pixels."""
+
+    def __init__(self, data):
+        self.data = bytes(data)
+
+    def get_width(self):
+        return 1
+
+    def get_height(self):
+        return 1
+
+    def get_n_channels(self):
+        return 4
+
+    def read_pixel_bytes(self):
+        return SimpleNamespace(get_data=lambda: self.data)
+
+
+@pytest.fixture
+def fetches(monkeypatch):
+    fetched = []
+
+    def drawable_pixbuf(drawable, width, height):
+        fetched.append(drawable.ID)
+        return FakePixbuf(drawable._data())
+    monkeypatch.setattr(fanim.Utils, "drawable_pixbuf", staticmethod(drawable_pixbuf))
+    return fetched
+
+
+def test_thumbnail_cache_revisions(fetches):
+    image = fake_gimpfu.make_image(2, 4, 4)
+    layer, other = image.layers
+    cache = fanim.ThumbnailCache()
+
+    thumb = cache.get(layer)
+    assert cache.get(layer) is thumb and cache.current(layer)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    cache.invalidate(layer)
+    assert not cache.current(layer)
+    assert cache.get(layer) is not thumb
+    assert fetches == [layer.ID, layer.ID]
+
+    # a resize shows in the revision, not in the counters.
+    cache.get(other)
+    other._width = 8
+    assert cache.current(other)
+    cache.get(other)
+    assert fetches[-2:] == [other.ID, other.ID]
+
+
+def test_thumbnail_cache_checks_layers_after_expire(fetches):
+    image = fake_gimpfu.make_image(2, 4, 4)
+    layer, other = image.layers
+    cache = fanim.ThumbnailCache()
+    cache.get(layer)
+    cache.get(other)
+    before = cache.revision(layer), cache.revision(other)
+    assert fetches == [layer.ID, other.ID]
+
+    layer._pixels[:4] = b"\x01\x02\x03\x04"
+    cache.expire()
+    assert not cache.current(layer) and not cache.current(other)
+
+    # one thumbnail per layer is fetched to compare, only the edited layer changed.
+    after = cache.revision(layer), cache.revision(other)
+    assert after[0] != before[0] and after[1] == before[1]
+    assert fetches == [layer.ID, other.ID, layer.ID, other.ID]
+    assert cache.current(other) and not cache.current(layer)
+
+    cache.get(other)
+    assert cache.hits == 1
+    assert cache.get(layer).data == bytes(layer._pixels)
+
+
+def test_thumbnail_cache_preloaded(fetches):
+    image = fake_gimpfu.make_image(3, 4, 4)
+    first, second, third = image.layers
+    stored = {l.tattoo: FakePixbuf(l._data()) for l in image.layers}
+    cache = fanim.ThumbnailCache()
+    cache.preload(dict(stored))
+
+    assert cache.get(first) is stored[first.tattoo]
+    cache.invalidate(second)
+    assert cache.get(second) is not stored[second.tattoo]
+    assert cache.disk_hits == 1 and fetches == [second.ID]
+
+    cache.expire()
+    cache.get(third)
+    assert cache.disk_hits == 1 and fetches == [second.ID, third.ID]
+
+
+def test_thumbnail_cache_evicts_least_recent(fetches):
+    image = fake_gimpfu.make_image(3, 4, 4)
+    a, b, c = image.layers
+    cache = fanim.ThumbnailCache(size=2)
+    cache.get(a)
+    cache.get(b)
+    cache.get(a)
+    cache.get(c)
+    assert cache.current(a) and cache.current(c) and not cache.current(b)
+
+
+# thumbnail store
+
+def pixel_bytes(pixbuf):
+    return pixbuf.read_pixel_bytes().get_data()
+
+
+def test_thumbnail_store_round_trip(tmp_path):
+    image = fake_gimpfu.make_image(3, 8, 6)
+    path = tmp_path / "walk.xcf"
+    path.write_bytes(b"gimp xcf")
+    image.filename = str(path)
+    layers = image.layers
+
+    cache = fanim.ThumbnailCache()
+    cache.persist = True
+    thumbs = [cache.get(l) for l in layers]
+    store = fanim.ThumbnailStore(image)
+    store.save(cache.persistent(layers))
+
+    loaded = store.load()
+    assert sorted(loaded) == sorted(l.tattoo for l in layers)
+    for layer, thumb in zip(layers, thumbs):
+        pixbuf = loaded[layer.tattoo]
+        assert (pixbuf.get_width(), pixbuf.get_height()) == (thumb.get_width(), thumb.get_height())
+        assert pixel_bytes(pixbuf) == pixel_bytes(thumb)
+
+    # preloaded in a new session, they are used instead of fetching.
+    other = fanim.ThumbnailCache()
+    other.preload(loaded)
+    other.get(layers[0])
+    assert (other.disk_hits, other.misses) == (1, 1)
+
+    # saving the file drops the thumbnails of the previous one.
+    path.write_bytes(b"gimp xcf, saved again")
+    assert store.load() == {}
+
+
+def test_thumbnail_store_saves_no_stale_thumbnail(tmp_path):
+    image = fake_gimpfu.make_image(2, 8, 6)
+    layer, other = image.layers
+    cache = fanim.ThumbnailCache()
+    cache.persist = True
+    cache.get(layer)
+    cache.get(other)
+
+    # drawn in GIMP and saved, the dirty flag is clean again.
+    layer._pixels[:4] = b"\x01\x02\x03\x04"
+    cache.expire()
+    thumbs = cache.persistent(image.layers)
+    assert pixel_bytes(thumbs[layer.tattoo]) == bytes(layer._pixels)
+    assert pixel_bytes(thumbs[other.tattoo]) == bytes(other._pixels)
+
+
+# spritesheet index
+
+class SheetTimeline:
+    """The parts of Timeline the numpy spritesheet export runs on."""
+
+    _frame_stacks = fanim.Timeline._frame_stacks
+    _frame_cells = fanim.Timeline._frame_cells
+    _create_spritesheet = fanim.Timeline._create_spritesheet
+    _duplicate_cell = fanim.Timeline._duplicate_cell
+    _sheet_index = fanim.Timeline._sheet_index
+    _save_sheet_index = fanim.Timeline._save_sheet_index
+
+    def __init__(self, image, dedupe):
+        cache = fanim.ThumbnailCache()
+        self.image = image
+        self.frames = [fanim.AnimFrame(l, cache) for l in reversed(image.layers)]
+        self.framerate = 10
+        self.dedupe_frames, self.dedupe_tolerance = dedupe, 0
+        self.sheet_columns, self.sheet_padding = 0, 0
+
+    def export(self, index_path=None):
+        """Run the export, return the spritesheet image."""
+        for _ in self._create_spritesheet(index_path):
+            pass
+        return fake_gimpfu.gimp.image_list()[-1]
+
+
+def sheet_image(frames, copies):
+    """An image of frames layers, copies mapping a frame to the one it repeats."""
+    image = fake_gimpfu.make_image(frames, 4, 3)
+    timeline = list(reversed(image.layers))
+    for frame, source in copies.items():
+        timeline[frame]._pixels = bytearray(timeline[source]._data())
+    return image
+
+
+def sheet_table(simg):
+    return json.loads(simg.parasite_find(fanim.SHEET_INDEX_PARASITE).data)
+
+
+def test_spritesheet_keeps_every_cell_without_dedupe():
+    simg = SheetTimeline(sheet_image(4, {1: 0, 3: 0}), False).export()
+    table = sheet_table(simg)
+    assert [f["cell"] for f in table["frames"]] == [0, 1, 2, 3]
+    assert (simg.width, simg.height) == (16, 3)
+
+
+def test_spritesheet_dedupe_shares_cells():
+    # frames 1 and 3 repeat frame 0.
+    image = sheet_image(5, {1: 0, 3: 0})
+    simg = SheetTimeline(image, True).export()
+    table = sheet_table(simg)
+    assert [f["cell"] for f in table["frames"]] == [0, 0, 1, 0, 2]
+    timeline = list(reversed(image.layers))
+    assert [f["name"] for f in table["frames"]] == [l.name for l in timeline]
+    assert (simg.width, simg.height) == (12, 3)
+
+    atlas = fanim.Pixels.read(simg.layers[0])
+    for cell, frame in enumerate((0, 2, 4)):
+        assert np.array_equal(atlas[:, cell * 4:cell * 4 + 4], fanim.Pixels.read(timeline[frame]))
+
+
+def test_spritesheet_index_file(tmp_path):
+    timeline = SheetTimeline(sheet_image(3, {2: 1}), True)
+
+    # skipped, the table is only kept in the sheet.
+    simg = timeline.export()
+    assert sheet_table(simg)["frames"][2]["cell"] == 1
+    assert not list(tmp_path.iterdir())
+
+    path = tmp_path / "walk-spritesheet.json"
+    simg = timeline.export(str(path))
+    assert json.loads(path.read_text()) == sheet_table(simg)
+
+
+# tinted onion skin
+
+def test_onion_skin_composites_at_preview_size(monkeypatch):
+    sizes = []
+    drawable_pixbuf = fanim.Utils.drawable_pixbuf
+
+    def fetch(drawable, width, height):
+        sizes.append((width, height))
+        return drawable_pixbuf(drawable, width, height)
+    monkeypatch.setattr(fanim.Utils, "drawable_pixbuf", staticmethod(fetch))
+
+    image = fake_gimpfu.make_image(3, 40, 2 * fanim.PREVIEW_HEIGHT)
+    past, active, future = reversed(image.layers)
+    # the left half of the active frame is transparent.
+    data = active._data()
+    for y in range(active.height):
+        row = y * active.width * 4
+        for x in range(active.width // 2):
+            data[row + x * 4 + 3] = 0
+
+    shown = []
+    cache = fanim.ThumbnailCache()
+    timeline = SimpleNamespace(image=image, thumbnails=cache,
+                               preview=SimpleNamespace(show_pixbuf=shown.append))
+    onion = fanim.OnionSkin(timeline)
+    frames = [fanim.AnimFrame(l, cache) for l in (past, active, future)]
+    onion.show(frames[1], [(frames[0], 50.0, True), (frames[2], 25.0, False)])
+
+    # no layer is read at full size.
+    assert (20, fanim.PREVIEW_HEIGHT) in sizes
+    assert max(h for w, h in sizes) == fanim.PREVIEW_HEIGHT
+    overlay = fanim.Pixels.from_pixbuf(shown[0])
+    assert overlay.shape == (fanim.PREVIEW_HEIGHT, 20, 4)
+    assert np.array_equal(overlay[:, 10:], fanim.Pixels.read(active)[::2, 20:][:, ::2])
+    assert overlay[:, :10, 3].min() > 0
+    assert not np.array_equal(overlay[:, :10, :3], fanim.Pixels.read(past)[:100, :10, :3])
+
+    # going back to the same frames reuses the overlay.
+    fetched = len(sizes)
+    onion.hide()
+    onion.show(frames[1], [(frames[0], 50.0, True), (frames[2], 25.0, False)])
+    assert len(sizes) == fetched and shown[-1] is shown[0]